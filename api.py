@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+from datetime import datetime
+
+from flask import Response, jsonify, request
+
+
+def ranked_rows(df, elimination=None):
+    rows = []
+    totals = df.sum(axis=1)
+    ranks = totals.rank(method='min', ascending=False)
+    for name in totals.sort_index().sort_values(ascending=False, kind='stable').index:
+        points = {}
+        for (phase, stage), pts in df.loc[name].items():
+            points.setdefault(f'Phase {phase}', {})[stage] = int(pts)
+        row = {'name': name, 'rank': int(ranks[name]), 'total': int(totals[name])}
+        if elimination is not None:
+            row.update({'max': int(elimination['Max'][name]), 'eliminated': bool(elimination['Eliminated'][name]),
+                        'out_of_prizes': bool(elimination['Out of Prizes'][name])})
+        row['points'] = points
+        rows.append(row)
+    return rows
+
+def standings_json(tournament):
+    '''
+    ranked participants of every competition with their points per phase and
+    stage and the most they can still finish with
+    '''
+    res = {}
+    for cid, comp in tournament.competitions.items():
+        res[comp] = ranked_rows(tournament.competition_standings(cid), tournament.competition_elimination(cid))
+    return res
+
+def history_json(tournament):
+    '''
+    rank of every participant after each change of the results, and the
+    places moved with the latest one
+    '''
+    res = {}
+    for cid, comp in tournament.competitions.items():
+        ranks = tournament.history.ranks(cid)
+        changes = tournament.history.rank_changes(cid)
+        res[comp] = {
+            'times': [t.isoformat() for t in ranks.index],
+            'ranks': {name: [int(r) for r in ranks[name]] for name in ranks.columns},
+            'change': {name: int(change) for name, change in changes.items()},
+        }
+    return res
+
+def consensus_json(tournament):
+    '''
+    pick popularity of every team per stage (per question for the bonus
+    stages) and the consensus of every match
+    '''
+    res = {}
+    for comp, consensus in tournament.consensus.items():
+        teams = [{'phase': int(phase), 'stage': stage, 'team': team,
+                  'question': question if isinstance(question, str) else None,
+                  'picks': int(row['Picks']), 'share': round(row['Share'], 4)}
+                 for (phase, stage, question, team), row in consensus['teams'].iterrows()]
+        matches = [{'phase': int(phase), 'stage': stage, 'id': mid, 'matchup': row['Matchup'],
+                    'predictions': int(row['Predictions']), 'top_score': row['Top Score'],
+                    'top_score_share': round(row['Top Score Share'], 4),
+                    'outcomes': {k.lower(): round(row[k], 4) for k in ('Home', 'Draw', 'Away')}}
+                   for (phase, stage, mid), row in consensus['matches'].iterrows()]
+        res[comp] = {'teams': teams, 'matches': matches}
+    return res
+
+def parse_what_if(values):
+    '''
+    hypothetical scores given as match_id:2-1 or HOME:AWAY:2-1
+    '''
+    scores = {}
+    for value in values:
+        parts = value.split(':')
+        if len(parts) == 3:
+            scores[(parts[0], parts[1])] = parts[2]
+        elif len(parts) == 2:
+            scores[parts[0]] = parts[1]
+        else:
+            raise ValueError(f'unknown score {value}')
+    return scores
+
+def what_if_json(tournament, scores):
+    return {comp: ranked_rows(df) for comp, df in tournament.what_if(scores).items()}
+
+def fixtures_json(tournament):
+    fixtures = []
+    for mid, match in sorted(tournament.actual.matches.items(), key=lambda x: (x[1].dt or datetime.max, str(x[0]))):
+        fixtures.append({
+            'id': mid,
+            'stage': match.stage,
+            'kickoff': match.dt.isoformat() if match.dt else None,
+            'teams': list(match.teams) if match.teams else None,
+            'score': [match.home, match.away] if match.score else None,
+            'outcome': match.outcome,
+        })
+    return fixtures
+
+def predictions_json(tournament, t0=0, t1=1):
+    '''
+    predicted scores of the matches played between t0 and t1 days from today
+    '''
+    res = {}
+    for comp, df in tournament.predicted_scores(t0, t1).items():
+        res[comp] = {name: {matchup: score for matchup, score in row.items() if isinstance(score, str)}
+                     for name, row in df.iterrows()}
+    return res
+
+def chances_json(tournament, scenarios=20000):
+    '''
+    simulated chances of every participant finishing first, second and in the prizes
+    '''
+    from simulate import Simulator
+    res = {}
+    for cid, comp in tournament.competitions.items():
+        df = Simulator.from_tournament(tournament, cid).run(scenarios, workers=1, seed=0)
+        res[comp] = [{'name': name, 'win': round(row['Win'], 4), 'runner_up': round(row['Runner Up'], 4),
+                      'prize': round(row['Prize'], 4), 'expected_points': round(row['Expected Points'], 2),
+                      'expected_rank': round(row['Expected Rank'], 2)}
+                     for name, row in df.iterrows()]
+    return res
+
+
+def register_api(server, get_tournament, render_cache, max_age=30, scenarios=20000):
+    '''
+    read-only json endpoints on the flask server
+
+    responses carry an ETag derived from the data version so clients and
+    proxies revalidate with a conditional GET and mostly get a 304 back.
+    get_tournament returns None while the tournament is loading, until then
+    the endpoints answer 503
+    '''
+    def respond(name, dated, render):
+        tournament = get_tournament()
+        if tournament is None:
+            return Response(status=503, headers={'Retry-After': '10'})
+        tournament.reload()
+        version = tournament.version
+        if dated:
+            version = f'{version}-{datetime.utcnow().date().isoformat()}'
+        etag = f'{name}-{version}'
+        headers = {'Cache-Control': f'public, max-age={max_age}', 'ETag': f'"{etag}"'}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        response = jsonify(render_cache.get(f'api-{name}', version, lambda: render(tournament)))
+        response.headers.update(headers)
+        return response
+
+    @server.route('/api/standings')
+    def api_standings():
+        return respond('standings', False, standings_json)
+
+    @server.route('/api/fixtures')
+    def api_fixtures():
+        return respond('fixtures', False, fixtures_json)
+
+    @server.route('/api/history')
+    def api_history():
+        return respond('history', False, history_json)
+
+    @server.route('/api/consensus')
+    def api_consensus():
+        return respond('consensus', False, consensus_json)
+
+    @server.route('/api/predictions')
+    def api_predictions():
+        # bounded so arbitrary ranges cannot fill the render cache
+        t0 = min(max(request.args.get('from', 0, type=int), -7), 7)
+        t1 = min(max(request.args.get('to', 1, type=int), t0), 7)
+        return respond(f'predictions-{t0}-{t1}', True,
+                       lambda tournament: predictions_json(tournament, t0, t1))
+
+    @server.route('/api/chances')
+    def api_chances():
+        # seeded so every worker simulating the same version agrees
+        return respond('chances', False, lambda tournament: chances_json(tournament, scenarios))
+
+    @server.route('/api/what-if')
+    def api_what_if():
+        # arbitrary scenarios so neither cached nor given an ETag
+        tournament = get_tournament()
+        if tournament is None:
+            return Response(status=503, headers={'Retry-After': '10'})
+        tournament.reload()
+        try:
+            scores = parse_what_if(request.args.getlist('score'))
+            return jsonify(what_if_json(tournament, scores))
+        except (KeyError, ValueError, TypeError) as e:
+            return jsonify({'error': str(e)}), 400
@@ -0,0 +1,37 @@
+// refresh the standings as soon as the server reports a score change
+(function () {
+    function refresh() {
+        var button = document.getElementById('live-refresh');
+        if (button) {
+            button.click();
+        }
+    }
+
+    // for browsers without EventSource or once the server has no stream to spare
+    function poll(version) {
+        fetch('/events/version', {cache: 'no-store'})
+            .then(function (response) { return response.json(); })
+            .then(function (data) {
+                if (version !== undefined && data.version !== version) {
+                    refresh();
+                }
+                setTimeout(function () { poll(data.version); }, data.poll * 1000);
+            })
+            .catch(function () {
+                setTimeout(function () { poll(version); }, 30000);
+            });
+    }
+
+    if (!window.EventSource) {
+        poll();
+        return;
+    }
+    var source = new EventSource('/events');
+    source.addEventListener('scores', refresh);
+    source.onerror = function () {
+        // a refused stream is not retried by the browser
+        if (source.readyState === EventSource.CLOSED) {
+            poll();
+        }
+    };
+})();
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import sqlite3
+import platform
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import combinations
+
+import yaml
+
+# keep the history and rendered layouts of the synthetic tournaments out of the real ones
+scratch = tempfile.mkdtemp(prefix='predictor-bench-')
+os.environ.setdefault('HISTORY_DIR', os.path.join(scratch, 'history'))
+os.environ.setdefault('RENDER_CACHE_DIR', os.path.join(scratch, 'render_cache'))
+# importing main for the render benchmarks must not reach the real db
+os.environ['WARM_ON_START'] = '0'
+os.environ['LIVE_UPDATES'] = '0'
+
+import numpy as np
+
+from predictor import Tournament, ActualBracket
+from simulate import Simulator
+
+metadata_path = os.environ.get("METADATA_YML", './tournaments/euro2024/metadata.yml')
+schema_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+SIZES = [10, 1000, 10000, 100000]
+
+
+class SqliteDB():
+    '''
+    in-memory sqlite stand-in for util.DB with the same query interface,
+    so a Tournament can be loaded without a MySQL server
+    '''
+
+    def __init__(self):
+        self.conn = sqlite3.connect(':memory:', check_same_thread=False,
+                                    detect_types=sqlite3.PARSE_DECLTYPES)
+        self.lock = threading.RLock()
+        self.stats = {'queries': 0}
+        self.create_schema()
+
+    def create_schema(self, path=schema_path):
+        with open(path, 'r') as f:
+            statements = f.read().split(';')
+        for statement in statements:
+            statement = statement.strip()
+            if not statement or statement.startswith('ALTER TABLE'):
+                continue
+            statement = (statement.replace('int PRIMARY KEY AUTO_INCREMENT', 'integer PRIMARY KEY')
+                                  .replace('DEFAULT (now())', 'DEFAULT CURRENT_TIMESTAMP'))
+            # index names are per table in MySQL but global in sqlite
+            statement = re.sub(r'INDEX `(\w+)` ON `(\w+)`', r'INDEX `\2_\1` ON `\2`', statement)
+            self.conn.execute(statement)
+
+    @staticmethod
+    def translate(query):
+        return query.replace('%s', '?').replace('REPLACE INTO', 'INSERT OR REPLACE INTO')
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            c = self.conn.cursor()
+            try:
+                yield SqliteCursor(c)
+            except BaseException:
+                self.conn.rollback()
+                raise
+            else:
+                self.conn.commit()
+            finally:
+                c.close()
+
+    def execute_many(self, *statements):
+        statements = [(query, list(rows)) for query, rows in statements]
+        statements = [(query, rows) for query, rows in statements if rows]
+        count = 0
+        with self.transaction() as c:
+            for query, rows in statements:
+                c.executemany(query, rows)
+                count += c.rowcount
+        self.stats['queries'] += len(statements)
+        return count
+
+    def query(self, query, args=None):
+        if query.lstrip().upper().startswith('CHECKSUM'):
+            # no equivalent, the tournament then loads without a snapshot
+            raise sqlite3.OperationalError('CHECKSUM TABLE is not supported')
+        with self.lock:
+            c = self.conn.execute(self.translate(query), args or ())
+            res = tuple(c.fetchall()) or None
+            self.conn.commit()
+        self.stats['queries'] += 1
+        while isinstance(res, tuple) and len(res)==1:
+            res = res[0]
+        return res
+
+    def get(self, table, what="*", order_by=None, asc=True, **kwargs):
+        query = f"SELECT {what} from {table}"
+        if kwargs:
+            query += " WHERE " + " AND ".join(f"{k}=%s" for k in kwargs)
+        if order_by:
+            query += f" ORDER BY {order_by}" + (" ASC" if asc else " DESC")
+        return self.query(query, tuple(kwargs.values()))
+
+    def pool_stats(self):
+        return dict(self.stats)
+
+
+class SqliteCursor():
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, args=None):
+        return self.cursor.execute(SqliteDB.translate(query), args or ())
+
+    def executemany(self, query, rows):
+        return self.cursor.executemany(SqliteDB.translate(query), rows)
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+
+def generate(db, config, participants, competitions=1, played=0.8, seed=0):
+    '''
+    fill db with the fixtures of config's groups and knockout rounds, the
+    results of the first played fraction of them and random predictions of
+    participants entrants per competition
+
+    kickoffs are laid out around now so upcoming predictions exist
+    '''
+    rnd = random.Random(seed)
+    groups = config['groups']
+    group_order = config['group_order']
+    knockout = ['Round of 16', 'Quarter-Finals', 'Semi-Finals', 'Final']
+
+    def result(knockout_match):
+        home, away = rnd.randint(0, 3), rnd.randint(0, 3)
+        if knockout_match and home == away:
+            # the score table holds no penalty outcome, a random side wins by a goal
+            if rnd.random() < 0.5:
+                home += 1
+            else:
+                away += 1
+        return home, away
+
+    fixtures, results = [], []
+    for group, teams in groups.items():
+        for k, (home, away) in enumerate(combinations(teams, 2)):
+            # alternate so every team has a home match, results look groups up by home team
+            fixtures.append([f'Group {group}'] + ([away, home] if k % 2 else [home, away]))
+            results.append(result(False))
+    # a knockout bracket of the group_order teams has one match less than it has teams
+    n_played = int((len(fixtures) + len(group_order) - 1) * played)
+    # the round of 16 teams are those placed in group_order, the winners of
+    # each round meet in order in the next. Teams of a match whose feeding
+    # matches are not played yet are not known
+    teams = [(team, 0) for team in group_order]
+    for stage in knockout:
+        winners = []
+        for (home, home_from), (away, away_from) in zip(teams[::2], teams[1::2]):
+            known = max(home_from, away_from) <= n_played
+            fixtures.append([stage, home if known else f'Winner {home_from}', away if known else f'Winner {away_from}'])
+            results.append(result(True))
+            h, a = results[-1]
+            winners.append((home if h > a else away, len(fixtures)))
+        teams = winners
+
+    start = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=8 * n_played)
+    fixture_rows, score_rows = [], []
+    for mid, ((stage, home, away), (home_score, away_score)) in enumerate(zip(fixtures, results), start=1):
+        fixture_rows.append((mid, home, away, start + timedelta(hours=8 * (mid - 1)), 1000 + mid, stage))
+        if mid <= n_played:
+            score_rows.append((home_score, away_score, mid, 'bench'))
+    db.execute_many(('INSERT INTO fixtures (id, home_team, away_team, kickoff, livescore_id, stage) '
+                     'VALUES (%s,%s,%s,%s,%s,%s)', fixture_rows),
+                    ('INSERT INTO score (home_score, away_score, match_id, source) VALUES (%s,%s,%s,%s)', score_rows))
+
+    all_teams = [team for teams in groups.values() for team in teams]
+    questions = config['scoring']['Phase 1'].get('Bonus KO', {}).get('questions', [])
+    pid = 0
+    for cid in range(1, competitions + 1):
+        db.execute_many(('INSERT INTO competition (id, name, description, entry_fee) VALUES (%s,%s,%s,%s)',
+                         [(cid, f'bench{cid}', f'Bench {cid}', 10)]))
+        participant_rows, match_rows, team_rows = [], [], []
+        for _ in range(participants):
+            pid += 1
+            participant_rows.append((pid, f'entrant{pid}', f'{pid}@bench', cid, 'sheet'))
+            for mid, (stage, _, _) in enumerate(fixtures, start=1):
+                home, away = rnd.randint(0, 3), rnd.randint(0, 3)
+                if stage.startswith('Group'):
+                    match_rows.append((home, away, mid, None, 1, pid))
+                else:
+                    match_rows.append((home, away, mid, rnd.choice((1, 2)) if home == away else None, 2, pid))
+            for group, members in groups.items():
+                for order, team in enumerate(rnd.sample(members, 2), start=1):
+                    team_rows.append((team, 'Round of 16', order, 1, pid))
+            for team in rnd.sample(all_teams, 16 - 2 * len(groups)):
+                team_rows.append((team, 'Round of 16', 3, 1, pid))
+            for stage, count in (('Semi-Finals', 4), ('Final', 2), ('Winner', 1), ('Bonus GS', 3)):
+                team_rows += [(team, stage, None, 1, pid) for team in rnd.sample(all_teams, count)]
+            team_rows += [(rnd.choice(all_teams), 'Bonus KO', None, 1, pid) for _ in questions]
+            for stage, count in (('Quarter-Finals', 8), ('Semi-Finals', 4), ('Final', 2)):
+                team_rows += [(team, stage, None, 2, pid) for team in rnd.sample(list(group_order), count)]
+        db.execute_many(('INSERT INTO participant (id, name, email, competition_id, sheet_id) '
+                         'VALUES (%s,%s,%s,%s,%s)', participant_rows),
+                        ('INSERT INTO match_prediction (home_score, away_score, match_id, match_result, phase, '
+                         'participant_id) VALUES (%s,%s,%s,%s,%s,%s)', match_rows),
+                        ('INSERT INTO team_prediction (team, stage, group_order, phase, participant_id) '
+                         'VALUES (%s,%s,%s,%s,%s)', team_rows))
+    return n_played
+
+
+def timed(timings, name, func, repeat=1):
+    '''
+    best of repeat calls of func, stored in timings[name] in seconds
+    '''
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        res = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    timings[name] = round(best, 6)
+    return res
+
+
+def render_benchmarks(tournament, cid, timings, repeat):
+    '''
+    the dashboard callbacks' render functions, skipped if the web app's
+    dependencies are not installed
+    '''
+    try:
+        import main
+    except ImportError as e:
+        print('skipping callback rendering:', e)
+        return str(e)
+    timed(timings, 'render_standings', lambda: main.render_standings(tournament, cid, 'overall', 1), repeat)
+    timed(timings, 'render_pred_scores', lambda: main.render_pred_scores(tournament, cid, 1), repeat)
+    phase, stage = tournament.team_stages[0]
+    timed(timings, 'render_pred_teams', lambda: main.render_pred_teams(tournament, cid, f'{phase}|{stage}', 1),
+          repeat)
+    return None
+
+
+def run(participants, config, competitions=1, played=0.8, seed=0, repeat=3, render=True, scenarios=1000):
+    '''
+    seconds taken by each step for a synthetic tournament of participants entrants per competition
+
+    scenarios - simulated by one process for the Monte Carlo step
+    '''
+    timings = {}
+    db = SqliteDB()
+    n_played = timed(timings, 'generate', lambda: generate(db, config, participants, competitions, played, seed))
+    rows = {table: db.query(f'SELECT COUNT(*) FROM {table}') for table in ('match_prediction', 'team_prediction')}
+
+    timed(timings, 'load_results', lambda: ActualBracket(db, config), repeat)
+    queries = db.stats['queries']
+    tournament = timed(timings, 'load_tournament', lambda: Tournament(f'bench-{participants}', db, config))
+    load_queries = db.stats['queries'] - queries
+    cid = next(iter(tournament.competitions))
+
+    def full_standings():
+        for engine in tournament.engines.values():
+            engine.reset()
+        return tournament.standings
+    timed(timings, 'standings', full_standings, repeat)
+    timed(timings, 'standings_cached', lambda: tournament.standings, repeat)
+
+    # one more result comes in
+    mid = n_played + 1
+    db.execute_many(('INSERT INTO score (home_score, away_score, match_id, source) VALUES (%s,%s,%s,%s)',
+                     [(1, 0, mid, 'bench')]))
+    def new_result():
+        tournament.reload(force=True)
+        return tournament.standings
+    timed(timings, 'reload_and_standings', new_result)
+
+    timed(timings, 'predicted_scores', lambda: tournament.predicted_scores(0, 1), repeat)
+    timed(timings, 'predicted_teams', lambda: tournament.predicted_teams, repeat)
+    timed(timings, 'max_points', lambda: tournament.competition_elimination(cid), repeat)
+    timed(timings, 'what_if', lambda: tournament.what_if({mid + 1: '2-1'}), repeat)
+    timed(timings, 'consensus', lambda: tournament.competition_consensus(cid))
+    simulator = timed(timings, 'simulator_build', lambda: Simulator.from_tournament(tournament, cid), repeat)
+    timed(timings, 'simulate', lambda: simulator.run(scenarios, workers=1, seed=seed))
+
+    skipped = render_benchmarks(tournament, cid, timings, repeat) if render else 'disabled'
+    return {
+        'participants': participants,
+        'competitions': competitions,
+        'fixtures': len(tournament.actual.matches),
+        'played': n_played,
+        'prediction_rows': rows,
+        'load_queries': load_queries,
+        'scenarios': scenarios,
+        'render_skipped': skipped,
+        'seconds': timings,
+    }
+
+
+def main(sizes=SIZES, output=None, **kwargs):
+    with open(metadata_path, 'r') as f:
+        config = yaml.load(f, Loader=yaml.Loader)
+    results = []
+    for size in sizes:
+        print(f'benchmarking {size} participants')
+        results.append(run(size, config, **kwargs))
+        print(json.dumps(results[-1]['seconds']))
+    report = {
+        'created': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'metadata': metadata_path,
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+        print('wrote', output)
+    else:
+        print(text)
+    return report
+
+
+if __name__ == '__main__':
+    # python bench.py [sizes, e.g. 10,1000] [output.json]
+    sizes = [int(s) for s in sys.argv[1].split(',')] if len(sys.argv) > 1 else SIZES
+    main(sizes, sys.argv[2] if len(sys.argv) > 2 else None)
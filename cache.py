@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import os
+import re
+import glob
+import json
+import time
+import fcntl
+import pickle
+import hashlib
+import threading
+
+# bump whenever the layout of a snapshot or the classes it pickles change
+SNAPSHOT_VERSION = 1
+
+snapshot_dir = os.environ.get("SNAPSHOT_DIR", './snapshots')
+render_dir = os.environ.get("RENDER_CACHE_DIR", './render_cache')
+
+checksum_query = 'CHECKSUM TABLE competition, participant, fixtures, match_prediction, team_prediction'
+
+
+def current_phase(config, now=None):
+    '''
+    number of phase deadlines which have already passed
+    '''
+    now = now or time.time()
+    return sum(dt.timestamp() <= now for dt in config.get('deadline', {}).values())
+
+def snapshot_key(db, config):
+    '''
+    key identifying the current state of the prediction tables
+
+    returns None if the database cannot checksum its tables in which case
+    snapshots are not used at all
+    '''
+    try:
+        checksums = db.query(checksum_query)
+    except Exception as e:
+        print('unable to checksum prediction tables:', e)
+        return None
+    if not checksums:
+        return None
+    digest = hashlib.sha1(repr((SNAPSHOT_VERSION, checksums)).encode()).hexdigest()[:16]
+    return f'phase{current_phase(config)}-{digest}'
+
+def slugify(name):
+    return re.sub(r'\W+', '-', name).strip('-').lower()
+
+def snapshot_path(name, key):
+    return os.path.join(snapshot_dir, f'{slugify(name)}-{key}.pkl')
+
+def load_snapshot(name, key):
+    if key is None:
+        return None
+    path = snapshot_path(name, key)
+    try:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f'ignoring unreadable snapshot {path}:', e)
+        return None
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('key') != key:
+        return None
+    print('loaded snapshot', path)
+    return snapshot
+
+def save_snapshot(name, key, snapshot):
+    '''
+    atomically write a snapshot and remove the stale ones of the same tournament
+    '''
+    if key is None:
+        return
+    path = snapshot_path(name, key)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    snapshot = dict(snapshot, version=SNAPSHOT_VERSION, key=key)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    for stale in glob.glob(snapshot_path(name, '*')):
+        if stale != path and not stale.endswith('.tmp'):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+    print('saved snapshot', path)
+
+
+class RenderCache():
+    '''
+    rendered layouts shared by every session and every gunicorn worker
+
+    a layout is rendered once per version (the data it was rendered from)
+    and kept in memory plus as json on disk, where the other workers pick it
+    up. A file lock per layout makes concurrent misses wait for the one
+    render instead of repeating it.
+    '''
+
+    def __init__(self, path=render_dir):
+        self.path = path
+        self.memory = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def entry_path(self, name, version):
+        digest = hashlib.sha1(repr(version).encode()).hexdigest()[:16]
+        return os.path.join(self.path, f'{slugify(name)}-{digest}.json')
+
+    def read(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f'ignoring unreadable render {path}:', e)
+            return None
+
+    def write(self, name, path, value):
+        from plotly.utils import PlotlyJSONEncoder
+
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(value, f, cls=PlotlyJSONEncoder)
+        os.replace(tmp, path)
+        # digest suffix only, so 'x-1' does not match the entries of 'x-1-2'
+        pattern = re.escape(slugify(name)) + r'-[0-9a-f]{16}\.json'
+        for stale in glob.glob(os.path.join(self.path, f'{slugify(name)}-*.json')):
+            if stale != path and re.fullmatch(pattern, os.path.basename(stale)):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+    def get(self, name, version, render):
+        '''
+        the layout called name at version, calling render() only if no
+        worker has rendered it yet
+        '''
+        with self.lock:
+            lock = self.locks.setdefault(name, threading.Lock())
+        with lock:
+            cached = self.memory.get(name)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            path = self.entry_path(name, version)
+            value = None
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                with open(os.path.join(self.path, f'{slugify(name)}.lock'), 'w') as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    value = self.read(path)
+                    if value is None:
+                        value = render()
+                        self.write(name, path, value)
+            except OSError as e:
+                print(f'render cache unavailable for {name}:', e)
+                if value is None:
+                    value = render()
+            self.memory[name] = (version, value)
+            return value
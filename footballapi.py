@@ -1,11 +1,12 @@
 import requests
 import os
 import dateutil.parser
-from bs4 import BeautifulSoup
-from time import time, sleep
+from time import time
 import datetime
 from collections import namedtuple
 from util import config
+from polling import PollScheduler, ScoreWriter
+from metrics import metrics, timed, pool_metrics
 
 API_KEY = os.environ["FOOTBALL_API_KEY"]
 api_url = 'https://apiv3.apifootball.com'
@@ -28,32 +29,6 @@ def from_fapi(x):
     return x
 
 
-def fetch_beautiful_markup(url):
-    print('fetching markup from ' + url)
-    
-    # try catching all possible http errors
-    try :
-        livescore_html = requests.get(url)
-    except Exception as e :
-        return print('An error occured as: ', e)
-
-    parsed_markup = BeautifulSoup(livescore_html.text, 'html.parser')
-    
-    return parsed_markup
-
-code_url = 'http://www.rsssf.com/miscellaneous/fifa-codes.html'
-codes = fetch_beautiful_markup(code_url)
-codes = codes.pre.get_text().splitlines()
-codes = [l.replace('\t', '').replace('-----','---') for l in codes if '\t' in l]
-fifa_codes = {l[:-6]:l[-6:-3] for l in codes}
-fifa_codes['North Macedonia'] = fifa_codes.pop('Macedonia FYR')
-fifa_codes['Netherlands'] = fifa_codes.pop('Holland')
-fifa_codes['Usa'] = fifa_codes.pop('United States of America')
-fifa_codes['South Korea'] = fifa_codes.pop('Korea Republic')
-fifa_codes['Australia'] = 'AUS'
-# two way mapping
-fifa_codes.update({v:k for k,v in fifa_codes.items()})
-
 group_map = {t:k for k,v in config['groups'].items() for t in v}
 
 def get_scores(league_id, stage=None, start='2024-06-14', stop='2024-07-15', live=False):
@@ -67,7 +42,8 @@ def get_scores(league_id, stage=None, start='2024-06-14', stop='2024-07-15', liv
         'APIkey': API_KEY,
         'match_live':int(live)
     }
-    r = requests.get(api_url, params)
+    with metrics.timer('poller_fetch_seconds', source='footballapi'):
+        r = requests.get(api_url, params)
     try:
         r.json()
     except:
@@ -166,57 +142,49 @@ def populate_from_fapi(league_id, db):
             entry = (fixture.home_team, fixture.away_team, fixture.dt.strftime('%Y-%m-%d %H:%M:%S'), fixture.id, fixture.stage)
             db.query(fixture_query, entry)
 
-def update_from_fapi(league_id, db, live=False, scores=True, fixtures=False):
+@timed('poller_cycle_seconds', source='footballapi')
+def update_from_fapi(league_id, db, live=False, scores=True, fixtures=False, writer=None):
     """
     populate the score and/or fixtures sql tables from footballapi
 
-    for fixtures table we always want to update rows in the table
-    for score table we always want to replace the current row in its entirety
+    only the scores and fixture teams which changed since the last write are
+    written, returns the ids of the matches whose score changed
     """
 
     comp_results = get_scores(league_id, live=live)
 
-    score_query = """REPLACE INTO score (home_score , away_score , match_id , source ) 
-            VALUES (%s,%s,%s,%s)"""
-    fixture_query = """UPDATE fixtures 
-            SET home_team=%s, away_team=%s
-            WHERE livescore_id=%s"""
-
     print(comp_results)
-    for stage in comp_results.values():
-        for fixture in stage.values():
-            if not fixtures and (fixture.home_score is None or fixture.home_score == '?'):
-                continue
-            match_id = db.get("fixtures","id", livescore_id=fixture.id)
-            if scores:
-                entry = (fixture.home_score, fixture.away_score, match_id, 'footballapi')
-                print(entry)
-                if fixture.home_score is not None and fixture.home_score != '?':
-                    db.query(score_query, entry)
-            if fixtures:
-                print('updating fixtures')
-                entry = (fixture.home_team, fixture.away_team, fixture.id)
-                db.query(fixture_query, entry)
-
-
-def main(league_id, db, update_interval, rescrape_interval, phase2_deadline):
-    last_update = time()
+    results = [fixture for stage in comp_results.values() for fixture in stage.values()]
+    changed = []
+    writer = writer or ScoreWriter(db, 'footballapi')
+    if scores:
+        changed = writer.write(results)
+    if fixtures:
+        writer.write_fixtures(results)
+    return changed
+
+
+def main(league_id, db, update_interval, rescrape_interval, phase2_deadline, idle_interval=3600):
+    scheduler = PollScheduler(db, live_interval=update_interval, idle_interval=idle_interval)
+    writer = ScoreWriter(db, 'footballapi')
     last_rescrape = time()
     # phase2_locked = time() > phase2_deadline
     while True:
-        if not (datetime.time(15) < datetime.datetime.now().time() < datetime.time(23,30)):
-            pass
-        elif (time() - last_rescrape) > rescrape_interval:
+        finished = scheduler.finished()
+        if (time() - last_rescrape) > rescrape_interval:
             print('Rescraping entire competition from footballapi')
             last_rescrape = time()
-            update_from_fapi(league_id, db, scores=True, fixtures=True)
-        elif (time() - last_update) > update_interval:
+            update_from_fapi(league_id, db, scores=True, fixtures=True, writer=writer)
+        elif finished:
+            print('Matches over, fetching final scores from footballapi')
+            update_from_fapi(league_id, db, scores=True, fixtures=False, writer=writer)
+        elif scheduler.live():
             print('Updating scores from footballapi')
-            last_update = time()
-            update_from_fapi(league_id, db, live=True, scores=True, fixtures=False)
+            update_from_fapi(league_id, db, live=True, scores=True, fixtures=False, writer=writer)
 
-        print('sleeping for ',update_interval)
-        sleep(update_interval)
+        pool_metrics(metrics, db)
+        metrics.dump(os.environ.get('METRICS_FILE'))
+        scheduler.wait()
         
         # if not phase2_locked and (time() > phase2_deadline):
         #     from util import build_services, get_creds, lock_prediction_sheet, update_predictions_db
@@ -239,8 +207,9 @@ if __name__ == "__main__":
     league_id = config['footballapi']['league_id']
     update_interval = config['footballapi']['interval']['update']
     rescrape_interval = config['footballapi']['interval'].get('rescrape', 1e12)
+    idle_interval = config['footballapi']['interval'].get('idle', 3600)
     phase2_deadline = config['deadline']['Phase 2'].timestamp()
     db = DB(config['sql'])
     # update_from_fapi(league_id, db, True, True)
     update_interval = 10
-    main(league_id, db, update_interval, rescrape_interval, phase2_deadline)
+    main(league_id, db, update_interval, rescrape_interval, phase2_deadline, idle_interval)
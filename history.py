@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import os
+import json
+import time
+import fcntl
+
+import numpy as np
+import pandas as pd
+
+from cache import slugify
+
+history_dir = os.environ.get("HISTORY_DIR", './history')
+
+
+class StandingsHistory():
+    '''
+    the standings of every competition each time the results changed
+
+    a competition's history is stored column wise in its own directory:
+    times.i8 holds the unix time of every snapshot and deltas.i4 the
+    participants x (phase, stage) points of each snapshot minus those of the
+    one before, so the full history is two reads and a cumulative sum.
+    meta.json names the rows and columns and counts the valid snapshots,
+    anything written past that count by an interrupted append is dropped.
+    '''
+
+    def __init__(self, name, path=history_dir):
+        self.path = os.path.join(path, slugify(name))
+        self.last = {}
+
+    def competition_path(self, cid, filename):
+        return os.path.join(self.path, str(cid), filename)
+
+    def read_meta(self, cid):
+        try:
+            with open(self.competition_path(cid, 'meta.json'), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def write_meta(self, cid, meta):
+        path = self.competition_path(cid, 'meta.json')
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, path)
+
+    def append(self, cid, version, names, columns, points):
+        '''
+        record the points (participants x columns) of the standings at version
+
+        every worker calls this after a reload, only the first one to see a
+        version writes it
+        '''
+        os.makedirs(os.path.join(self.path, str(cid)), exist_ok=True)
+        points = np.asarray(points, dtype=np.int32)
+        columns = [list(col) for col in columns]
+        with open(self.competition_path(cid, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            meta = self.read_meta(cid)
+            if meta is None or meta['names'] != list(names) or meta['columns'] != columns:
+                if meta is not None:
+                    print(f'participants or stages of competition {cid} changed, restarting its history')
+                meta = {'names': list(names), 'columns': columns, 'count': 0, 'versions': []}
+                self.last.pop(cid, None)
+            if version in meta['versions']:
+                return False
+            count = meta['count']
+            last = self.last.get(cid)
+            if last is None or last[0] != count:
+                last = (count, self.read(cid, meta)[1][-1] if count else np.zeros_like(points))
+            for filename, row in (('times.i8', np.array([time.time()], dtype=np.int64)),
+                                  ('deltas.i4', points - last[1])):
+                with open(self.competition_path(cid, filename), 'ab') as f:
+                    # drop whatever an interrupted append left behind
+                    f.truncate(count * row.nbytes)
+                    f.seek(0, os.SEEK_END)
+                    row.tofile(f)
+            meta['count'] = count + 1
+            meta['versions'] = meta['versions'][-999:] + [version]
+            self.write_meta(cid, meta)
+            self.last[cid] = (count + 1, points)
+        return True
+
+    def read(self, cid, meta=None):
+        '''
+        times (snapshots) and points (snapshots x participants x columns)
+        '''
+        meta = meta or self.read_meta(cid)
+        if meta is None or not meta['count']:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 0, 0), dtype=np.int32)
+        count = meta['count']
+        shape = (len(meta['names']), len(meta['columns']))
+        times = np.fromfile(self.competition_path(cid, 'times.i8'), dtype=np.int64, count=count)
+        deltas = np.fromfile(self.competition_path(cid, 'deltas.i4'), dtype=np.int32,
+                             count=count * shape[0] * shape[1])
+        return times, np.cumsum(deltas.reshape((count,) + shape), axis=0, dtype=np.int32)
+
+    def ranks(self, cid):
+        '''
+        rank of every participant (columns) after every snapshot (rows), ties share the best rank
+        '''
+        meta = self.read_meta(cid)
+        times, points = self.read(cid, meta)
+        if meta is None:
+            return pd.DataFrame()
+        totals = points.sum(axis=2)
+        ranks = np.empty(totals.shape, dtype=np.int64)
+        for t, total in enumerate(totals):
+            ranks[t] = len(total) - np.searchsorted(np.sort(total), total, side='right') + 1
+        index = pd.to_datetime(times, unit='s')
+        index.name = 'Time'
+        return pd.DataFrame(ranks, index=index, columns=meta['names'])
+
+    def rank_changes(self, cid, since=None):
+        '''
+        places gained (positive) or lost by every participant since the
+        snapshot before the latest one, or the last one taken before since (unix time)
+        '''
+        ranks = self.ranks(cid)
+        if len(ranks) < 2:
+            return pd.Series(0, index=ranks.columns, dtype=np.int64)
+        previous = ranks.iloc[-2]
+        if since is not None:
+            before = ranks[ranks.index <= pd.to_datetime(since, unit='s')]
+            previous = before.iloc[-1] if len(before) else ranks.iloc[0]
+        return previous - ranks.iloc[-1]
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import threading
+from time import time, sleep
+
+from flask import Response, jsonify
+
+from polling import as_rows
+
+
+class ChangeListener(threading.Thread):
+    '''
+    follows the change_log table the score pollers append to
+
+    as soon as new rows show up the tournament results are reloaded and
+    every open /events stream is woken up, so a goal reaches the browsers
+    within a few seconds instead of at the next refresh interval
+    '''
+
+    last_query = "SELECT COALESCE(MAX(id), 0) FROM change_log"
+    change_query = "SELECT id, match_id FROM change_log WHERE id > %s ORDER BY id"
+
+    def __init__(self, db, get_tournament, interval=2):
+        '''
+        get_tournament - returns the tournament to reload, or None while it is still loading
+        '''
+        super().__init__(name='change-listener', daemon=True)
+        self.db = db
+        self.get_tournament = get_tournament
+        self.interval = interval
+        self.last_id = None
+        self.version = 0
+        self.changed = threading.Condition()
+
+    def poll(self):
+        '''
+        returns the ids of the matches changed since the last poll
+        '''
+        if self.last_id is None:
+            # changes from before we started are already in the loaded results
+            self.last_id = int(self.db.query(self.last_query) or 0)
+            return set()
+        rows = as_rows(self.db.query(self.change_query, (self.last_id,)))
+        if not rows:
+            return set()
+        self.last_id = rows[-1][0]
+        match_ids = set(match_id for _, match_id in rows)
+        print('scores changed for matches', match_ids)
+        tournament = self.get_tournament()
+        if tournament is None:
+            # it will read the new results when it finishes loading
+            return match_ids
+        tournament.reload(force=True)
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+        return match_ids
+
+    def wait(self, version, timeout):
+        '''
+        block until the version moves on from version or timeout seconds pass
+        '''
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print('change listener failed to poll:', e)
+            sleep(self.interval)
+
+
+def register_events(server, listener, heartbeat=25, lifetime=300, max_streams=8, poll=10):
+    '''
+    server-sent events endpoint emitting a scores event whenever the listener
+    picks up a change
+
+    each stream holds a worker thread, so at most max_streams are open at a
+    time and each is closed after lifetime seconds, the browser's EventSource
+    reconnects on its own. Clients turned away get a 503 and fall back to
+    polling /events/version every poll seconds, which answers from memory
+    '''
+    streams = threading.BoundedSemaphore(max_streams)
+
+    def stream():
+        version = listener.version
+        yield 'retry: 5000\n\n'
+        end = time() + lifetime
+        while time() < end:
+            current = listener.wait(version, heartbeat)
+            if current != version:
+                version = current
+                yield f'event: scores\ndata: {version}\n\n'
+            else:
+                # keeps proxies from timing out an idle connection
+                yield ': heartbeat\n\n'
+
+    @server.route('/events')
+    def events():
+        if not streams.acquire(blocking=False):
+            return Response('too many open streams\n', status=503, mimetype='text/plain',
+                            headers={'Retry-After': str(lifetime)})
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        response = Response(stream(), mimetype='text/event-stream', headers=headers)
+        # also called if the client leaves before the stream starts
+        response.call_on_close(streams.release)
+        return response
+
+    @server.route('/events/version')
+    def events_version():
+        # the version of the results rather than the listener's count, which
+        # differs between workers
+        tournament = listener.get_tournament()
+        response = jsonify(version=tournament.version if tournament else None, poll=poll)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    return events
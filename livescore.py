@@ -4,9 +4,11 @@ import os
 import dateutil.parser
 from bs4 import BeautifulSoup
 from urllib import parse
-from time import time, sleep
+from time import time
 from datetime import datetime
 from collections import namedtuple
+from polling import PollScheduler, ScoreWriter
+from metrics import metrics, timed, pool_metrics
 
 gen_score = lambda : f'{random.randint(0,3)} - {random.randint(0,3)}'
 parse_min = lambda x: int(x.strip().replace("'",""))
@@ -28,28 +30,16 @@ def fetch_beautiful_markup(url):
     
     # try catching all possible http errors
     try :
-        livescore_html = requests.get(url)
+        with metrics.timer('poller_fetch_seconds', source='livescore'):
+            livescore_html = requests.get(url)
     except Exception as e :
+        metrics.inc('poller_fetch_errors_total', source='livescore')
         return print('An error occured as: ', e)
 
     parsed_markup = BeautifulSoup(livescore_html.text, 'html.parser')
     
     return parsed_markup
 
-code_url = 'http://www.rsssf.com/miscellaneous/fifa-codes.html'
-codes = fetch_beautiful_markup(code_url)
-codes = codes.pre.get_text().splitlines()
-codes = [l.replace('\t', '').replace('-----','---') for l in codes if '\t' in l]
-fifa_codes = {l[:-6]:l[-6:-3] for l in codes}
-fifa_codes['North Macedonia'] = fifa_codes.pop('Macedonia FYR')
-fifa_codes['Netherlands'] = fifa_codes.pop('Holland')
-fifa_codes['Usa'] = fifa_codes.pop('United States of America')
-fifa_codes['South Korea'] = fifa_codes.pop('Korea Republic')
-fifa_codes['Australia'] = 'AUS'
-# two way mapping
-fifa_codes.update({v:k for k,v in fifa_codes.items()})
-
-
 def extract_scores(url):
 
     parsed_markup = fetch_beautiful_markup(url)
@@ -158,12 +148,13 @@ def populate_from_livescore(url, db):
 
 
 
-def update_from_livescore(url, db, full=False, scores=True, fixtures=False):
+@timed('poller_cycle_seconds', source='livescore')
+def update_from_livescore(url, db, full=False, scores=True, fixtures=False, writer=None):
     """
     populate the score and/or fixtures sql tables from livescore 
 
-    for fixtures table we always want to update rows in the table
-    for score table we always want to replace the current row in its entirety
+    only the scores and fixture teams which changed since the last write are
+    written, returns the ids of the matches whose score changed
     """
 
     if full:
@@ -171,42 +162,34 @@ def update_from_livescore(url, db, full=False, scores=True, fixtures=False):
     else:
         comp_results = extract_scores(url)
 
-    score_query = """REPLACE INTO score (home_score , away_score , match_id , source ) 
-            VALUES (%s,%s,%s,%s)"""
-    fixture_query = """UPDATE fixtures 
-            SET home_team=%s, away_team=%s
-            WHERE livescore_id=%s"""
+    results = [fixture for stage in comp_results.values() for fixture in stage.values()]
+    changed = []
+    writer = writer or ScoreWriter(db, 'livescore')
+    if scores:
+        changed = writer.write(results)
+    if fixtures:
+        writer.write_fixtures(results)
+    return changed
 
-    for stage in comp_results.values():
-        for fixture in stage.values():
-            if not fixtures and (fixture.home_score is None or fixture.home_score == '?'):
-                continue
-            match_id = db.get("fixtures","id", livescore_id=fixture.id)
-            if scores:
-                entry = (fixture.home_score, fixture.away_score, match_id, 'livescore')
-                if fixture.home_score is not None and fixture.home_score != '?':
-                    db.query(score_query, entry)
-            if fixtures:
-                entry = (fixture.home_team, fixture.away_team, fixture.id)
-                db.query(fixture_query, entry)
-
-
-def main(url, db, update_interval, rescrape_interval, phase2_deadline):
-    last_update = time()
+
+def main(url, db, update_interval, rescrape_interval, phase2_deadline, idle_interval=3600):
+    scheduler = PollScheduler(db, live_interval=update_interval, idle_interval=idle_interval,
+                              alarms=[phase2_deadline])
+    writer = ScoreWriter(db, 'livescore')
     last_rescrape = time()
     phase2_locked = time() > phase2_deadline
     while True:
+        finished = scheduler.finished()
         if (time() - last_rescrape) > rescrape_interval:
             print('Rescraping entire competition from livescore')
             last_rescrape = time()
-            update_from_livescore(url, db, full=True, scores=True, fixtures=False)
-        elif (time() - last_update) > update_interval:
+            update_from_livescore(url, db, full=True, scores=True, fixtures=False, writer=writer)
+        elif finished or scheduler.live():
             print('Updating scores from livescore')
-            last_update = time()
-            update_from_livescore(url, db, full=False, scores=True, fixtures=True)
+            update_from_livescore(url, db, full=False, scores=True, fixtures=True, writer=writer)
         
         if not phase2_locked and (time() > phase2_deadline):
-            from util import build_services, get_creds, lock_prediction_sheet, update_predictions_db
+            from util import build_services, get_creds, lock_prediction_sheet, update_predictions_db, sheet_fetcher
             token = os.environ.get("GOOGLE_APP_TOKEN", "google_token.json")
             creds_file = os.environ.get("GOOGLE_APP_CREDENTIALS", "google_credentials.json")
             creds = get_creds(token, creds_file)
@@ -217,10 +200,13 @@ def main(url, db, update_interval, rescrape_interval, phase2_deadline):
             except:
                 pass
             try:
-                update_predictions_db(sheets, db, 2)
-            except:
-                pass
-        sleep(update_interval)
+                update_predictions_db(sheets, db, 2, fetcher=sheet_fetcher(creds))
+            except Exception as e:
+                print('unable to update the phase 2 predictions:', e)
+            phase2_locked = True
+        pool_metrics(metrics, db)
+        metrics.dump(os.environ.get('METRICS_FILE'))
+        scheduler.wait()
 
 
 if __name__ == "__main__":
@@ -228,6 +214,7 @@ if __name__ == "__main__":
     url = config['livescore']['url']
     update_interval = config['livescore']['interval']['update']
     rescrape_interval = config['livescore']['interval'].get('rescrape', 1e12)
+    idle_interval = config['livescore']['interval'].get('idle', 3600)
     phase2_deadline = config['deadline']['Phase 2'].timestamp()
     db = DB(config['sql'])
-    main(url, db, update_interval, rescrape_interval, phase2_deadline)
+    main(url, db, update_interval, rescrape_interval, phase2_deadline, idle_interval)
@@ -6,11 +6,17 @@ from dateutil.tz import gettz
 
 import yaml
 import dash
-from dash import dcc, ctx, html
+from dash import dcc, ctx, html, callback
+from dash.exceptions import PreventUpdate
+from flask import jsonify
 import dash_bootstrap_components as dbc
 from pandas import DataFrame
 from dash.dependencies import Input, Output, State
-from predictor import Tournament
+from predictor import LazyTournament
+from cache import RenderCache
+from live import ChangeListener, register_events
+from api import register_api
+from metrics import metrics, timed, register_metrics
 from util import DB, config, gen_entry, build_services, get_creds
 
 USE_GOOGLE = int(os.environ.get("USE_GOOGLE", 1))
@@ -23,8 +29,8 @@ mlt = gettz('Europe/Malta')
 
 #------------------------------ HELPER FUNCTIONS ------------------------------- #
 
-col_ordering = ['Ranking','Name', 'Group Stage', 'Round of 16', 'Quarter-Finals', 'Semi-Finals', 
-                'Final', 'Winner', 'Bonus GS', 'Bonus KO', 'Total']
+col_ordering = ['Ranking','Move','Name', 'Group Stage', 'Round of 16', 'Quarter-Finals', 'Semi-Finals', 
+                'Final', 'Winner', 'Bonus GS', 'Bonus KO', 'Total', 'Max', 'Status']
 
 def to_local(dt):
     dt = dt.astimezone(utc)
@@ -48,20 +54,31 @@ color_code = {'Group Stage': 'info',
 # ----------------------------- DASH ---------------------------------- #
 
 
+# nothing below connects to anything, the pool opens connections on first use
+# and the tournament loads in the background (see create_app)
 db = DB(config['sql'])
-logger.info(f"connected to mysql database successfully: {db}")
+WARM_ON_START = int(os.environ.get("WARM_ON_START", 1))
+# 0 keeps the change listener from following the db, e.g. when importing for the benchmarks
+LIVE_UPDATES = int(os.environ.get("LIVE_UPDATES", 1))
 
 if USE_GOOGLE:
-    token = os.environ.get("GOOGLE_APP_TOKEN", "google_token.json")
-    creds_file = os.environ.get("GOOGLE_APP_CREDENTIALS", "google_credentials.json")
-    creds = get_creds(token, creds_file)
-    services = build_services(creds)
-    logger.info(f"build google services successfully")
     template_id = config['google_api']['template_id']
     folder_id = config['google_api']['folder_id']
 
+services = None
+
+def google_services():
+    global services
+    if services is None:
+        token = os.environ.get("GOOGLE_APP_TOKEN", "google_token.json")
+        creds_file = os.environ.get("GOOGLE_APP_CREDENTIALS", "google_credentials.json")
+        creds = get_creds(token, creds_file)
+        services = build_services(creds)
+        logger.info(f"build google services successfully")
+    return services
+
 t_name = config['tournament']
-tournament = Tournament(t_name, db, config)
+loader = LazyTournament(t_name, db, config)
 
 external_stylesheets=[dbc.themes.MINTY]
 DARK = False
@@ -69,20 +86,50 @@ if DARK:
     BASE = 'light'
 else:
     BASE = 'dark'
-app  = dash.Dash(__name__ , external_stylesheets=external_stylesheets)
-server = app.server
-app.title = t_name
-app.config.suppress_callback_exceptions = True
 
-def prep_standings(df):
-    df['Total'] = df.sum(axis=1)
+# the tabs are identical for every viewer so render them once per data version
+render_cache = RenderCache()
+
+def current_tournament():
+    '''
+    the loaded tournament, callbacks fired before it is ready are skipped
+    '''
+    tournament = loader.get()
+    if tournament is None:
+        raise PreventUpdate
+    return tournament
+
+def today():
+    return datetime.utcnow().date().isoformat()
+
+PAGE_SIZE = 50
+
+def paginate(df, page):
+    pages = max(1, -(-len(df) // PAGE_SIZE))
+    page = min(max(page or 1, 1), pages)
+    return df.iloc[(page-1)*PAGE_SIZE:page*PAGE_SIZE], pages
+
+def to_table(df):
+    return dbc.Table.from_dataframe(df, dark=DARK, striped=True, bordered=True, hover=True, responsive=True)
+
+def prep_standings(df, page=1):
+    df['Total'] = df.drop(columns=['Max', 'Status', 'Move'], errors='ignore').sum(axis=1)
     df = df.sort_index().sort_values('Total', ascending=False)
     df['Ranking'] = df.Total.rank(method='min', ascending=False)
     df = df.reset_index()
     cols = [col for col in col_ordering if col in df.columns]
-    df = df[cols]
-    tbl = dbc.Table.from_dataframe(df, dark=DARK, striped=True, bordered=True, hover=True, responsive=True)
-    return tbl
+    df, pages = paginate(df[cols], page)
+    return to_table(df), pages
+
+def competition_tabs(component_id, tournament):
+    '''
+    one empty tab per competition, only the active one's content is rendered
+    '''
+    tabs = [dbc.Tab(label=comp, tab_id=str(cid)) for cid, comp in tournament.competitions.items()]
+    return dbc.Tabs(tabs, id=component_id, active_tab=tabs[0].tab_id if tabs else None, persistence=True)
+
+def phases(tournament):
+    return sorted(set(phase for engine in tournament.engines.values() for phase, _ in engine.columns))
 
 def get_score_cards(matches, tdy=None):
     cards = []
@@ -280,16 +327,18 @@ email_input = html.Div(
     className="mb-3",
 )
 
-comps = db.get('competition', '*')
-if not isinstance(comps[0], tuple):
-    comps = (comps,)
-comp_options = [{"label": f"{desc} (€{fee})", "value":cid} for cid, name, desc, fee in comps]
-# eventually the options should come from sql
+def competition_options():
+    comps = db.get('competition', '*')
+    if not isinstance(comps[0], tuple):
+        comps = (comps,)
+    return [{"label": f"{desc} (€{fee})", "value":cid} for cid, name, desc, fee in comps]
+
+# options are filled in by load_competition_options when the form is shown
 competition_input = html.Div(
     [
         dbc.Label("Competition", html_for="competition-form"),
         dbc.Select(
-                    options=comp_options,
+                    options=[],
                     id="competition-form"
         ),
     ],
@@ -409,57 +458,74 @@ comp_tabs = dbc.Tabs(comp_tabs, persistence=True)
 '''
 
 
-standings_tab_content = dbc.Card(
-    dbc.CardBody(
-        [
-            html.H2(
-                "Standings",
-                style={
-                    "width": "100%",
-                    "text-align": "center",
-                    "padding-top": "2%",
-                    "padding-bottom": "2%",
-                },
-            ),
-            html.Div(id='scoring-table'),		
-        ]
-    ),
-    className="mt-3",
-)
+def standings_tab(tournament):
+    return dbc.Card(
+        dbc.CardBody(
+            [
+                html.H2(
+                    "Standings",
+                    style={
+                        "width": "100%",
+                        "text-align": "center",
+                        "padding-top": "2%",
+                        "padding-bottom": "2%",
+                    },
+                ),
+                competition_tabs('standings-comp', tournament),
+                dbc.Tabs([dbc.Tab(label='Overall', tab_id='overall')] +
+                         [dbc.Tab(label=f'Phase {phase}', tab_id=str(phase)) for phase in phases(tournament)],
+                         id='standings-view', active_tab='overall', persistence=True, className="mt-3"),
+                dcc.Loading(html.Div(id='scoring-table', className="mt-3")),
+                dbc.Pagination(id='standings-page', max_value=1, active_page=1, fully_expanded=False),
+            ]
+        ),
+        className="mt-3",
+    )
 
-score_pred_tab_content = dbc.Card(
-    dbc.CardBody(
-        [
-            html.H2(
-                "Upcoming Predicted Scores",
-                style={
-                    "width": "100%",
-                    "text-align": "center",
-                    "padding-bottom": "2%",
-                },
-            ),
-            html.Div(id='pred-table'),		
-        ]
-    ),
-    className="mt-3",
-)
+def score_pred_tab(tournament):
+    return dbc.Card(
+        dbc.CardBody(
+            [
+                html.H2(
+                    "Upcoming Predicted Scores",
+                    style={
+                        "width": "100%",
+                        "text-align": "center",
+                        "padding-bottom": "2%",
+                    },
+                ),
+                competition_tabs('pred-comp', tournament),
+                dcc.Loading(html.Div(id='pred-table', className="mt-3")),
+                dbc.Pagination(id='pred-page', max_value=1, active_page=1, fully_expanded=False),
+            ]
+        ),
+        className="mt-3",
+    )
 
-team_pred_tab_content = dbc.Card(
-    dbc.CardBody(
-        [
-            html.H2(
-                "Predicted Teams",
-                style={
-                    "width": "100%",
-                    "text-align": "center",
-                    "padding-bottom": "2%",
-                },
-            ),
-            html.Div(id='pred-team-table'),		
-        ]
-    ),
-    className="mt-3",
-)
+def team_pred_tab(tournament):
+    team_stage_options = [{'label': f'Phase {phase} - {stage}', 'value': f'{phase}|{stage}'}
+                          for phase, stage in tournament.team_stages if stage != 'Group Stage']
+    return dbc.Card(
+        dbc.CardBody(
+            [
+                html.H2(
+                    "Predicted Teams",
+                    style={
+                        "width": "100%",
+                        "text-align": "center",
+                        "padding-bottom": "2%",
+                    },
+                ),
+                competition_tabs('teams-comp', tournament),
+                dbc.Select(id='teams-stage', options=team_stage_options, className="mt-3",
+                           value=team_stage_options[0]['value'] if team_stage_options else None,
+                           persistence=True),
+                dcc.Loading(html.Div(id='pred-team-table', className="mt-3")),
+                dbc.Pagination(id='teams-page', max_value=1, active_page=1, fully_expanded=False),
+            ]
+        ),
+        className="mt-3",
+    )
 
 result_tab_content = dbc.Card(
     dbc.CardBody(
@@ -472,60 +538,89 @@ result_tab_content = dbc.Card(
                     "padding-bottom": "2%",
                 },
             ),
-            html.Div(id='score-cards'),		
+            dcc.Loading(html.Div(id='score-cards')),
         ]
     ),
     className="mt-3",
 )
 
-app.layout = dbc.Container(
-    html.Div([
-        html.H1(config['tournament'],
-                style={
-                    "width": "100%",
-                    "text-align": "center",
-                    "padding-top": "2%",
-                    "padding-bottom": "2%",
-                    },
-                ),
-        html.H2('Today\'s Matches',
-                style={
-                    "width": "100%",
-                    "text-align": "center",
-                    "padding-top": "2%",
-                    "padding-bottom": "2%",
-                    },
-                ),
-       html.Div(id = 'today-score-cards'),
-       dbc.Tabs(
-            [
-                # dbc.Tab(signup_tab_content, label="Sign Up"),
-                dbc.Tab(standings_tab_content, label="Standings"),
-                dbc.Tab(score_pred_tab_content, label="Upcoming Predicted Scores"),
-                dbc.Tab(team_pred_tab_content, label="Predicted Teams"),
-                dbc.Tab(result_tab_content, label="Results and Fixtures"),
-                dbc.Tab(rules_tab_content, label="Rules and Point System"),
-            ],
-            persistence=True,
-                ),
-        dcc.Interval(
-            id='scoring-interval-component',
-            interval=6*60*60*1000, # in milliseconds
-            n_intervals=0
-        ),
-        dcc.Interval(
-            id='pred-interval-component',
-            interval=6*60*60*1000, # in milliseconds
-            n_intervals=0
-        ),
+def loading_layout():
+    '''
+    served while the tournament is still loading, reloads the page once it is ready
+    '''
+    return dbc.Container(
+        html.Div([
+            html.H1(config['tournament'],
+                    style={
+                        "width": "100%",
+                        "text-align": "center",
+                        "padding-top": "2%",
+                        "padding-bottom": "2%",
+                        },
+                    ),
+            dbc.Spinner(html.P('Loading standings...', style={'textAlign': 'center'}), color='primary'),
+            dcc.Location(id='ready-location', refresh=True),
+            dcc.Interval(id='ready-interval', interval=3000, n_intervals=0),
+        ]),
+        fluid=True,
+        )
+
+def serve_layout():
+    tournament = loader.get()
+    if tournament is None:
+        return loading_layout()
+    return dbc.Container(
+        html.Div([
+            html.H1(config['tournament'],
+                    style={
+                        "width": "100%",
+                        "text-align": "center",
+                        "padding-top": "2%",
+                        "padding-bottom": "2%",
+                        },
+                    ),
+            html.H2('Today\'s Matches',
+                    style={
+                        "width": "100%",
+                        "text-align": "center",
+                        "padding-top": "2%",
+                        "padding-bottom": "2%",
+                        },
+                    ),
+           html.Div(id = 'today-score-cards'),
+           dbc.Tabs(
+                [
+                    # dbc.Tab(signup_tab_content, label="Sign Up"),
+                    dbc.Tab(standings_tab(tournament), label="Standings", tab_id='standings'),
+                    dbc.Tab(score_pred_tab(tournament), label="Upcoming Predicted Scores", tab_id='pred-scores'),
+                    dbc.Tab(team_pred_tab(tournament), label="Predicted Teams", tab_id='pred-teams'),
+                    dbc.Tab(result_tab_content, label="Results and Fixtures", tab_id='results'),
+                    dbc.Tab(rules_tab_content, label="Rules and Point System", tab_id='rules'),
+                ],
+                id='main-tabs',
+                active_tab='standings',
+                persistence=True,
+                    ),
+            # clicked by assets/live.js when a score changes
+            html.Button(id='live-refresh', n_clicks=0, style={'display': 'none'}),
+            dcc.Interval(
+                id='scoring-interval-component',
+                interval=6*60*60*1000, # in milliseconds
+                n_intervals=0
+            ),
+            dcc.Interval(
+                id='pred-interval-component',
+                interval=6*60*60*1000, # in milliseconds
+                n_intervals=0
+            ),
 
-    ]),
-    fluid=True,
-    )
+        ]),
+        fluid=True,
+        )
 
 # --- Callbacks --- #
 '''
-@app.callback(
+@callback(
     Output("submit-success-alert", "is_open"),
     Output("submit-fail-alert", "is_open"),
     Output("alert-error-text", "children"),
@@ -555,13 +650,13 @@ def handle_form(n_clicks, name, surname, email, competition, valid_email, is_suc
         email = email.strip().lower()
 
         try:
-            gen_entry(services, full_name, email, competition, db, 
+            gen_entry(google_services(), full_name, email, competition, db, 
                     template_id, folder_id, config['tournament'])
             return True, False, ""
         except Exception as e:
             return False, True, str(e)
 
-@app.callback(
+@callback(
     [Output("email-form", "valid"), Output("email-form", "invalid")],
     [Input("email-form", "value")],
 )
@@ -574,97 +669,168 @@ def check_validity(email):
 '''
 
 # Multiple components can update everytime interval gets fired.
-@app.callback(
-              [
+# Only the content of the active tab is rendered, the others are left as they are
+@callback(
               Output('scoring-table', 'children'),
-              Output('score-cards', 'children'),
-              Output('today-score-cards', 'children'),
-              ],
-              Input('scoring-interval-component', 'n_intervals'))
-def update_scoring_live(n):
+              Output('standings-page', 'max_value'),
+              Input('scoring-interval-component', 'n_intervals'),
+              Input('live-refresh', 'n_clicks'),
+              Input('standings-comp', 'active_tab'),
+              Input('standings-view', 'active_tab'),
+              Input('standings-page', 'active_page'))
+@timed('dash_callback_seconds', callback='update_scoring_live')
+def update_scoring_live(n, clicks, cid, view, page):
+    tournament = current_tournament()
     tournament.reload()
-    dfs = tournament.standings
-    comp_tabs = []
-    for comp, df in dfs.items():
-        df.index.name = 'Name'
-        df = df.loc[:, (df.sum() > 0)]
-        p_tabs = []
-        # Compute overall standings
-        o_df = df.groupby(level=1, axis=1).sum()
-        o_tbl = prep_standings(o_df)
-        tab = dbc.Tab(dbc.Card(dbc.CardBody([o_tbl]),className="mt-3"),
-                                label='Overall', tab_id=f'standings-{comp}-overall')
-        p_tabs.append(tab)
-        for phase in df.columns.get_level_values(0).unique():
-            p_tbl = prep_standings(df[phase].copy())
-            tab = dbc.Tab(dbc.Card(dbc.CardBody([p_tbl]),className="mt-3"),
-                                    label=f'Phase {phase}', tab_id=f'standings-{comp}-{phase}')
-            p_tabs.append(tab)
-        
-        phase_tabs = dbc.Tabs(p_tabs, persistence=True)
-
-        c_tab = dbc.Tab(dbc.Card(dbc.CardBody([phase_tabs]),className="mt-3"),
-                            label=comp, tab_id=f'standings-{comp}')
-        comp_tabs.append(c_tab)
-    
-    score_cards = get_score_cards(tournament.actual.matches)
-    live_score_cards = get_score_cards(tournament.actual.matches, tdy=True)
-
-    return (dbc.Tabs(comp_tabs, persistence=True), 
-            score_cards,
-            live_score_cards,
-           )
+    if cid is None:
+        return dash.no_update, dash.no_update
+    return render_cache.get(f'standings-{cid}-{view}-{page}', tournament.version,
+                            lambda: render_standings(tournament, int(cid), view, page))
+
+def render_standings(tournament, cid, view, page):
+    df = tournament.competition_standings(cid)
+    df = df.loc[:, (df.sum() > 0)]
+    if view == 'overall':
+        df = df.groupby(level=1, axis=1).sum()
+        elimination = tournament.competition_elimination(cid)
+        df['Max'] = elimination['Max']
+        df['Status'] = ''
+        df.loc[elimination['Out of Prizes'], 'Status'] = 'Out of the prizes'
+        df.loc[elimination['Eliminated'] & ~elimination['Out of Prizes'], 'Status'] = 'Cannot win'
+        changes = tournament.history.rank_changes(cid).reindex(df.index, fill_value=0)
+        df['Move'] = [f'▲{c}' if c > 0 else f'▼{-c}' if c < 0 else '' for c in changes]
+    elif int(view) in df.columns.get_level_values(0):
+        df = df[int(view)].copy()
+    else:
+        df = DataFrame(index=df.index)
+    df.index.name = 'Name'
+    return prep_standings(df, page)
 
+@callback(
+              Output('today-score-cards', 'children'),
+              Input('scoring-interval-component', 'n_intervals'),
+              Input('live-refresh', 'n_clicks'))
+@timed('dash_callback_seconds', callback='update_today_live')
+def update_today_live(n, clicks):
+    tournament = current_tournament()
+    tournament.reload()
+    # today's cards change at midnight even if no result does
+    return render_cache.get('today-score-cards', (tournament.version, today()),
+                            lambda: get_score_cards(tournament.actual.matches, tdy=True))
 
-# Multiple components can update everytime interval gets fired.
-@app.callback(
+@callback(
+              Output('score-cards', 'children'),
+              Input('main-tabs', 'active_tab'),
+              Input('scoring-interval-component', 'n_intervals'),
+              Input('live-refresh', 'n_clicks'))
+@timed('dash_callback_seconds', callback='update_results_live')
+def update_results_live(tab, n, clicks):
+    if tab != 'results':
+        return dash.no_update
+    tournament = current_tournament()
+    return render_cache.get('score-cards', tournament.version,
+                            lambda: get_score_cards(tournament.actual.matches))
+
+
+@callback(
               Output('pred-table', 'children'),
-              Input('pred-interval-component', 'n_intervals'))
-def update_pred_scores_live(n):
-    comp_tabs = []
-    dfs = tournament.predicted_scores(0,1)
-    for comp, df in dfs.items():
-        df.index.name = 'Name'
-        df = df.reset_index()
-        tbl = dbc.Table.from_dataframe(df, dark=DARK, striped=True, bordered=True, hover=True, responsive=True)
-        tab = dbc.Tab(dbc.Card(dbc.CardBody([tbl]),className="mt-3"), label=comp, tab_id=f'scores-{comp}')
-        comp_tabs.append(tab)
-    
-    return dbc.Tabs(comp_tabs, persistence=True)
-
-@app.callback(
+              Output('pred-page', 'max_value'),
+              Input('main-tabs', 'active_tab'),
+              Input('pred-interval-component', 'n_intervals'),
+              Input('pred-comp', 'active_tab'),
+              Input('pred-page', 'active_page'))
+@timed('dash_callback_seconds', callback='update_pred_scores_live')
+def update_pred_scores_live(tab, n, cid, page):
+    if tab != 'pred-scores' or cid is None:
+        return dash.no_update, dash.no_update
+    tournament = current_tournament()
+    return render_cache.get(f'pred-scores-{cid}-{page}', (tournament.version, today()),
+                            lambda: render_pred_scores(tournament, int(cid), page))
+
+def render_pred_scores(tournament, cid, page):
+    df = tournament.competition_predicted_scores(cid, 0, 1)
+    df.index.name = 'Name'
+    df, pages = paginate(df.reset_index(), page)
+    return to_table(df), pages
+
+@callback(
               Output('pred-team-table', 'children'),
-              Input('pred-interval-component', 'n_intervals'))
-def update_pred_teams_live(n):
-    comp_tabs = []
-    dfs = tournament.predicted_teams
-    for comp, df in dfs.items():
-        p_tabs = []
-        for phase in df.columns.get_level_values(0).unique():
-            pdf = df[phase]
-            s_tabs = []
-            for stage in pdf.columns.get_level_values(0).unique():
-                if stage == 'Group Stage': continue
-                sdf = pdf[stage]
-                sdf.index.name = 'Name'
-                sdf = sdf.sort_index(axis=1).reset_index()
-                s_table = dbc.Table.from_dataframe(sdf,
-                            dark=DARK, striped=True, bordered=True, hover=True, responsive=True)
-                tab = dbc.Tab(dbc.Card(dbc.CardBody([s_table]),className="mt-3"),
-                                label=stage, tab_id=f'teams-{comp}-{phase}-{stage}')
-                s_tabs.append(tab)
-
-            stage_tabs = dbc.Tabs(s_tabs, persistence=True)
-            tab = dbc.Tab(dbc.Card(dbc.CardBody([stage_tabs]),className="mt-3"),
-                                label=f'Phase {phase}', tab_id=f'teams-{comp}-{phase}')
-            p_tabs.append(tab)
-        phase_tabs = dbc.Tabs(p_tabs, persistence=True)
-        c_tab = dbc.Tab(dbc.Card(dbc.CardBody([phase_tabs]),className="mt-3"),
-                            label=comp, tab_id=f'teams-{comp}')
-        comp_tabs.append(c_tab)
-
-    return dbc.Tabs(comp_tabs, persistence=True)
-
+              Output('teams-page', 'max_value'),
+              Input('main-tabs', 'active_tab'),
+              Input('pred-interval-component', 'n_intervals'),
+              Input('teams-comp', 'active_tab'),
+              Input('teams-stage', 'value'),
+              Input('teams-page', 'active_page'))
+@timed('dash_callback_seconds', callback='update_pred_teams_live')
+def update_pred_teams_live(tab, n, cid, stage, page):
+    if tab != 'pred-teams' or cid is None or not stage:
+        return dash.no_update, dash.no_update
+    tournament = current_tournament()
+    return render_cache.get(f'pred-teams-{cid}-{stage}-{page}', tournament.version,
+                            lambda: render_pred_teams(tournament, int(cid), stage, page))
+
+def render_pred_teams(tournament, cid, stage, page):
+    phase, stage = stage.split('|', 1)
+    df = tournament.competition_predicted_teams(cid)
+    if (int(phase), stage) not in set(c[:2] for c in df.columns):
+        return html.P('No predictions for this stage.'), 1
+    sdf = df[int(phase)][stage]
+    sdf.index.name = 'Name'
+    sdf, pages = paginate(sdf.sort_index(axis=1).reset_index(), page)
+    return to_table(sdf), pages
+
+
+@callback(
+              Output('ready-location', 'href'),
+              Input('ready-interval', 'n_intervals'))
+@timed('dash_callback_seconds', callback='reload_when_ready')
+def reload_when_ready(n):
+    if not loader.ready.is_set():
+        raise PreventUpdate
+    return '/'
+
+@callback(
+              Output('competition-form', 'options'),
+              Input('competition-form', 'id'))
+@timed('dash_callback_seconds', callback='load_competition_options')
+def load_competition_options(_):
+    return competition_options()
+
+
+def create_app():
+    '''
+    builds the dash app without loading any data, the tournament is warmed up
+    in the background (or on the first request if WARM_ON_START is 0)
+    '''
+    app = dash.Dash(__name__ , external_stylesheets=external_stylesheets)
+    app.title = t_name
+    app.config.suppress_callback_exceptions = True
+    app.layout = serve_layout
+
+    # pushes score changes written by the pollers to the browsers (assets/live.js)
+    live_config = config.get('live', {})
+    listener = ChangeListener(db, loader.get, interval=live_config.get('interval', 2))
+    if LIVE_UPDATES:
+        listener.start()
+    register_events(app.server, listener, heartbeat=live_config.get('heartbeat', 25),
+                    lifetime=live_config.get('lifetime', 300), max_streams=live_config.get('max_streams', 8),
+                    poll=live_config.get('poll', 10))
+    register_api(app.server, loader.get, render_cache, max_age=config.get('api', {}).get('max_age', 30),
+                 scenarios=config.get('simulation', {}).get('api_scenarios', 20000))
+
+    register_metrics(app.server, metrics, db)
+
+    @app.server.route('/ready')
+    def ready():
+        status = {'ready': loader.ready.is_set(), 'error': loader.error}
+        return jsonify(status), 200 if status['ready'] else 503
+
+    if WARM_ON_START:
+        loader.start()
+    return app
+
+app = create_app()
+server = app.server
 
 if __name__ == '__main__':
     app.run_server(host='0.0.0.0', port=8050, debug=True,) # use_reloader=False)
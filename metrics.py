@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+import os
+import threading
+from time import perf_counter
+from functools import wraps
+from contextlib import contextmanager
+
+# seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# queries per request
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Metrics():
+    '''
+    counters, gauges and histograms of the process, rendered in the prometheus text format
+
+    every gunicorn worker and poller keeps its own, samples carry a pid
+    label so the series of different workers behind one /metrics url do not
+    overwrite each other
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+        # per thread work done for the request being served, see begin/end
+        self.scope = threading.local()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, buckets=BUCKETS, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0, 'count': 0}
+            for i, bound in enumerate(hist['buckets']):
+                if value <= bound:
+                    hist['counts'][i] += 1
+                    break
+            hist['sum'] += value
+            hist['count'] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - started, **labels)
+
+    def timed(self, name, **labels):
+        '''
+        decorator recording the duration of every call in the histogram name
+        '''
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def query(self, statement, seconds):
+        '''
+        record a db round-trip, also counted against the request being served
+        '''
+        self.inc('db_queries_total', statement=statement)
+        self.observe('db_query_seconds', seconds, statement=statement)
+        if getattr(self.scope, 'active', False):
+            self.scope.queries += 1
+
+    def begin(self):
+        self.scope.active = True
+        self.scope.queries = 0
+        self.scope.started = perf_counter()
+
+    def end(self, **labels):
+        if not getattr(self.scope, 'active', False):
+            return
+        self.scope.active = False
+        self.observe('http_request_seconds', perf_counter() - self.scope.started, **labels)
+        self.observe('http_request_db_queries', self.scope.queries, buckets=COUNT_BUCKETS, **labels)
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {k: dict(v, counts=list(v['counts'])) for k, v in self.histograms.items()}
+        pid = ('pid', str(os.getpid()))
+        lines = []
+        for name in sorted(set(k[0] for k in counters)):
+            lines.append(f'# TYPE {name} counter')
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f'{name}{format_labels(labels + (pid,))} {value}')
+        for name in sorted(set(k[0] for k in gauges)):
+            lines.append(f'# TYPE {name} gauge')
+            for (n, labels), value in sorted(gauges.items()):
+                if n == name:
+                    lines.append(f'{name}{format_labels(labels + (pid,))} {value}')
+        for name in sorted(set(k[0] for k in histograms)):
+            lines.append(f'# TYPE {name} histogram')
+            for (n, labels), hist in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(hist['buckets'], hist['counts']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + (pid, ("le", str(bound))))} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels + (pid, ("le", "+Inf")))} {hist["count"]}')
+                lines.append(f'{name}_sum{format_labels(labels + (pid,))} {hist["sum"]:.6f}')
+                lines.append(f'{name}_count{format_labels(labels + (pid,))} {hist["count"]}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        '''
+        one line per series: counter values, call counts and mean durations
+        '''
+        with self.lock:
+            values = sorted(list(self.counters.items()) + list(self.gauges.items()))
+            lines = [f'{name}{format_labels(labels)} {value}' for (name, labels), value in values]
+            for (name, labels), hist in sorted(self.histograms.items()):
+                mean = hist['sum'] / hist['count'] if hist['count'] else 0
+                lines.append(f'{name}{format_labels(labels)} count={hist["count"]} mean={mean:.4f}')
+        return '\n'.join(lines)
+
+    def dump(self, path=None):
+        '''
+        for the pollers, which serve no http: write the metrics to path for a
+        node exporter textfile collector, or print a summary if not given
+        '''
+        if not path:
+            print(self.summary())
+            return
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def register_metrics(server, metrics, db=None):
+    '''
+    times every request and counts its db queries, and serves /metrics
+
+    db - the util.DB whose connection pool stats are exported as gauges
+    '''
+    from flask import Response, request
+
+    @server.before_request
+    def begin_request():
+        metrics.begin()
+
+    @server.after_request
+    def end_request(response):
+        metrics.end(endpoint=request.url_rule.rule if request.url_rule else 'unmatched')
+        return response
+
+    @server.route('/metrics')
+    def metrics_endpoint():
+        if db is not None:
+            pool_metrics(metrics, db)
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    return metrics_endpoint
+
+
+def pool_metrics(metrics, db):
+    '''
+    copy the connection pool stats of db into gauges
+    '''
+    stats = db.pool_stats()
+    for stat in ('open', 'in_use', 'idle', 'waits', 'health_checks', 'reconnects'):
+        metrics.set(f'db_pool_{stat}', stats[stat])
+
+
+metrics = Metrics()
+timed = metrics.timed
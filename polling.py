@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+from time import time, sleep
+from datetime import datetime, timedelta
+from dateutil.tz import gettz
+
+from metrics import metrics
+
+mlt = gettz('Europe/Malta')
+
+
+def as_rows(res):
+    '''
+    undo DB.query collapsing single row and single column results
+    '''
+    if res is None or res == ():
+        return ()
+    if not isinstance(res, tuple):
+        return ((res,),)
+    if not isinstance(res[0], tuple):
+        return (res,)
+    return res
+
+
+def parse_score(value):
+    '''
+    the goals in a scraped score, or None if it is not a number
+    '''
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class PollScheduler():
+    '''
+    decides when the score pollers should next hit their source
+
+    matches are live from lead before their kickoff until match_length after
+    it, during which the pollers poll every live_interval seconds. Otherwise
+    they sleep until the next match goes live, waking up at least every
+    idle_interval seconds to pick up fixture changes, or at one of the alarms
+    (unix timestamps) such as a phase deadline.
+    '''
+
+    kickoff_query = "SELECT kickoff FROM fixtures ORDER BY kickoff"
+
+    def __init__(self, db, live_interval=60, idle_interval=3600, lead=timedelta(minutes=5),
+                 match_length=timedelta(minutes=200), alarms=None):
+        self.db = db
+        self.live_interval = live_interval
+        self.idle_interval = idle_interval
+        self.lead = lead
+        self.match_length = match_length
+        self.alarms = sorted(alarms or [])
+        self.kickoffs = []
+        self.load_time = 0
+        self.was_live = False
+
+    @staticmethod
+    def now():
+        # kickoffs are stored as naive local times
+        return datetime.now(tz=mlt).replace(tzinfo=None)
+
+    def load(self):
+        self.kickoffs = [row[0] for row in as_rows(self.db.query(self.kickoff_query))]
+        self.load_time = time()
+
+    def live(self, now=None):
+        if time() - self.load_time > self.idle_interval:
+            self.load()
+        now = now or self.now()
+        return any(k - self.lead <= now <= k + self.match_length for k in self.kickoffs)
+
+    def finished(self, now=None):
+        '''
+        True once when the pollers leave a live window, so they can do a last
+        full poll for the final scores
+        '''
+        live = self.live(now)
+        finished = self.was_live and not live
+        self.was_live = live
+        return finished
+
+    def next_poll(self, now=None):
+        '''
+        seconds to sleep before the next poll
+        '''
+        now = now or self.now()
+        if self.live(now):
+            return self.live_interval
+        upcoming = [k - self.lead for k in self.kickoffs if k - self.lead > now]
+        wait = (upcoming[0] - now).total_seconds() if upcoming else self.idle_interval
+        alarms = [a - time() for a in self.alarms if a > time()]
+        if alarms:
+            wait = min(wait, alarms[0])
+        return max(1, min(wait, self.idle_interval))
+
+    def wait(self):
+        interval = self.next_poll()
+        print('sleeping for ', interval)
+        sleep(interval)
+
+
+class ScoreWriter():
+    '''
+    writes the scores and fixture teams read by a poller, keeping the
+    livescore_id -> match id map and the last written score and teams of
+    every match in memory so that only those which actually changed are
+    written, in one batch
+
+    every write also appends the changed match ids to change_log, in the same
+    transaction, which is what the web app follows to push live updates
+    '''
+
+    fixture_query = "SELECT livescore_id, id, home_team, away_team FROM fixtures"
+    current_query = "SELECT match_id, home_score, away_score FROM score"
+    score_query = """REPLACE INTO score (home_score , away_score , match_id , source ) 
+            VALUES (%s,%s,%s,%s)"""
+    teams_query = """UPDATE fixtures 
+            SET home_team=%s, away_team=%s
+            WHERE id=%s"""
+    change_query = "INSERT INTO change_log (match_id) VALUES (%s)"
+    prune_query = "DELETE FROM change_log WHERE created_at < NOW() - INTERVAL 1 DAY"
+
+    def __init__(self, db, source):
+        self.db = db
+        self.source = source
+        self.match_ids = {}
+        self.scores = {}
+        self.teams = {}
+        # livescore ids the fixtures table did not have at the last load
+        self.unknown = set()
+        self.load()
+
+    def load(self):
+        fixtures = as_rows(self.db.query(self.fixture_query))
+        self.match_ids = {str(lid): mid for lid, mid, _, _ in fixtures}
+        self.teams = {mid: (home, away) for _, mid, home, away in fixtures}
+        self.scores = {mid: (home, away) for mid, home, away in as_rows(self.db.query(self.current_query))}
+
+    def resolve(self, fixtures):
+        '''
+        reload if fixtures has ids added since the last load, once per id
+        '''
+        ids = set(str(f.id) for f in fixtures) - set(self.match_ids) - self.unknown
+        if ids:
+            self.load()
+            self.unknown |= ids - set(self.match_ids)
+
+    def write(self, fixtures):
+        '''
+        fixtures - Score tuples from a poller, those without a numeric score are skipped
+        returns the ids of the matches whose score changed
+        '''
+        scored = []
+        for fixture in fixtures:
+            score = (parse_score(fixture.home_score), parse_score(fixture.away_score))
+            if None not in score:
+                scored.append((fixture, score))
+            elif fixture.home_score not in (None, '?') or fixture.away_score not in (None, '?'):
+                print('skipping unreadable score', fixture)
+        self.resolve([f for f, _ in scored])
+
+        entries = []
+        for fixture, score in scored:
+            match_id = self.match_ids.get(str(fixture.id))
+            if match_id is None:
+                continue
+            if self.scores.get(match_id) != score:
+                entries.append((score[0], score[1], match_id, self.source))
+
+        if entries:
+            print('writing scores', entries)
+            with self.db.transaction() as c:
+                c.executemany(self.score_query, entries)
+                c.executemany(self.change_query, [(match_id,) for _, _, match_id, _ in entries])
+                c.execute(self.prune_query)
+            for home, away, match_id, _ in entries:
+                self.scores[match_id] = (home, away)
+            metrics.inc('poller_rows_written_total', len(entries), source=self.source, table='score')
+        return [match_id for _, _, match_id, _ in entries]
+
+    def write_fixtures(self, fixtures):
+        '''
+        fixtures - Score tuples from a poller
+        returns the ids of the matches whose teams changed
+        '''
+        self.resolve(fixtures)
+
+        entries = []
+        for fixture in fixtures:
+            match_id = self.match_ids.get(str(fixture.id))
+            if match_id is None:
+                continue
+            if self.teams.get(match_id) != (fixture.home_team, fixture.away_team):
+                entries.append((fixture.home_team, fixture.away_team, match_id))
+
+        if entries:
+            print('updating fixtures', entries)
+            with self.db.transaction() as c:
+                c.executemany(self.teams_query, entries)
+                c.executemany(self.change_query, [(match_id,) for _, _, match_id in entries])
+            for home, away, match_id in entries:
+                self.teams[match_id] = (home, away)
+            metrics.inc('poller_rows_written_total', len(entries), source=self.source, table='fixtures')
+        return [match_id for _, _, match_id in entries]
@@ -1,18 +1,41 @@
 #!/usr/bin/env python
 
 import re
+import copy
 import time
+import hashlib
+import threading
+import weakref
 from collections import Counter
+from types import MappingProxyType
 from datetime import datetime, timedelta
 from dateutil.tz import gettz
 from itertools import product
 
 import pandas as pd
 
-from livescore import fifa_codes
+from teams import fifa_codes
+from scoring import ScoringEngine
+from cache import snapshot_key, load_snapshot, save_snapshot
+from history import StandingsHistory
+from metrics import timed
 
 mlt = gettz('Europe/Malta')
 
+KNOCKOUT_STAGES = ['Round of 16', 'Quarter-Finals', 'Semi-Finals', 'Final']
+
+# one copy of every team tuple, score tuple and set of teams, these repeat
+# across the brackets and are bounded by the fixtures and the predictions
+_interned = {}
+# raw team names -> interned tuple of codes
+_team_codes = {}
+# identical predictions of a match share one Score, see Score.shared
+_shared_scores = weakref.WeakValueDictionary()
+
+def intern(value):
+    return _interned.setdefault(value, value)
+
+@timed('load_seconds', step='get_predictions_db')
 def get_predictions_db(db, pid, stage, phase):
     match_query = '''
         SELECT p.match_id, p.home_score, p.away_score, p.match_result, f.home_team, f.away_team, f.kickoff
@@ -38,33 +61,109 @@ def get_predictions_db(db, pid, stage, phase):
         stage = 'Group%'
 
     match_preds = db.query(match_query, (pid, stage, phase) )
+    if match_preds and not isinstance(match_preds[0], tuple):
+        match_preds = (match_preds,)
+    team_preds = db.query(team_query, (pid, stage, phase))
+    if team_preds and not isinstance(team_preds[0], tuple):
+        team_preds = (team_preds,)
+
+    return parse_predictions(stage, match_preds, team_preds, group_map)
+
+def parse_predictions(stage, match_preds, team_preds, group_map):
+    '''
+    build the matches and teams of a predicted stage from the raw prediction rows
+
+    match_preds - (match_id, home_score, away_score, match_result, home_team, away_team, kickoff) rows
+    team_preds - (team, group_order) rows
+    '''
     matches = {}
     if match_preds:
-        if not isinstance(match_preds[0], tuple):
-            match_preds = (match_preds,)
         for mid, home_score, away_score, match_outcome, home_team, away_team, kickoff in match_preds:
             score = (home_score, away_score)
             m_teams = (home_team, away_team)
             if int(mid) in (49,50):
                 score = tuple(reversed(score))
-            matches[mid] = Score(mid, score, m_teams, dt=kickoff, stage=stage, outcome=match_outcome)
+            matches[mid] = Score.shared(mid, score, m_teams, dt=kickoff, stage=stage, outcome=match_outcome)
 
-    team_preds = db.query(team_query, (pid, stage, phase))
     teams = []
     if team_preds:
-        if not isinstance(team_preds[0], tuple):
-            team_preds = (team_preds,)
         for team, group_order in team_preds:
             if group_order:
                 if stage == 'Round of 16':
                     g = group_map[team]
                     o = f'{g.split()[1]}{group_order}'
-                teams.append((team, o))
+                teams.append(intern((team, o)))
             else:
                 teams.append(team)
 
     return matches, teams
 
+class Predictions():
+    '''
+    every prediction of a competition, loaded in three queries and served
+    from memory in the same shape as get_predictions_db
+    '''
+
+    match_query = '''
+        SELECT p.participant_id, p.phase, p.match_id, p.home_score, p.away_score, p.match_result
+        FROM match_prediction as p
+        JOIN participant as pt
+        ON p.participant_id=pt.id
+        WHERE pt.competition_id=%s
+    '''
+    team_query = '''
+        SELECT t.participant_id, t.phase, t.stage, t.team, t.group_order
+        FROM team_prediction as t
+        JOIN participant as pt
+        ON t.participant_id=pt.id
+        WHERE pt.competition_id=%s
+    '''
+    fixture_query = '''
+        SELECT id, home_team, away_team, kickoff, stage
+        FROM fixtures
+    '''
+
+    def __init__(self, match_preds, team_preds, fixtures):
+        self.group_map = {}
+        fixture_map = {}
+        for mid, home_team, away_team, kickoff, stage in fixtures or ():
+            if stage.startswith('Group'):
+                self.group_map[home_team] = stage
+                stage = 'Group%'
+            fixture_map[mid] = (home_team, away_team, kickoff, stage)
+
+        self.matches = {}
+        for pid, phase, mid, home_score, away_score, match_result in match_preds or ():
+            if mid not in fixture_map:
+                continue
+            home_team, away_team, kickoff, stage = fixture_map[mid]
+            row = (mid, home_score, away_score, match_result, home_team, away_team, kickoff)
+            self.matches.setdefault((pid, stage, phase), []).append(row)
+
+        self.teams = {}
+        for pid, phase, stage, team, group_order in team_preds or ():
+            self.teams.setdefault((pid, stage, phase), []).append((team, group_order))
+
+    @classmethod
+    @timed('load_seconds', step='predictions')
+    def from_db(cls, db, cid):
+        queries = (cls.match_query, cls.team_query, cls.fixture_query)
+        rows = []
+        for query, args in zip(queries, ((cid,), (cid,), None)):
+            res = db.query(query, args)
+            if res and not isinstance(res[0], tuple):
+                res = (res,)
+            rows.append(res)
+        return cls(*rows)
+
+    def get(self, pid, stage, phase):
+        if stage == 'Group Stage':
+            stage = 'Group%'
+        match_preds = self.matches.get((pid, stage, phase))
+        team_preds = self.teams.get((pid, stage, phase))
+        return parse_predictions(stage, match_preds, team_preds, self.group_map)
+
+@timed('load_seconds', step='get_results_db')
 def get_results_db(db, config):
     results_query = '''
         SELECT f.id, s.home_score, s.away_score, f.home_team, f.away_team, f.kickoff, f.stage
@@ -121,7 +220,25 @@ def parse_team(team):
         except KeyError:
             return team.strip().split(' ')[-1].title()
 
+def team_codes(teams):
+    '''
+    the interned tuple of codes of teams, None if a team is not known
+    '''
+    teams = tuple(teams)
+    if teams not in _team_codes:
+        try:
+            if isinstance(teams[0], tuple):
+                codes = tuple([(fifa_codes[team[0]], team[1]) for team in teams])
+            else:
+                codes = tuple([fifa_codes[team] for team in teams])
+            _team_codes[teams] = intern(codes)
+        except KeyError:
+            _team_codes[teams] = None
+    return _team_codes[teams]
+
 class Score():
+    __slots__ = ('mid', 'home', 'away', 'score', 'teams', 'outcome', 'dt', 'stage', '__weakref__')
+
     def __init__(self, mid, score, teams=None, dt=None, stage=None, use_code=False, outcome=None):
         self.mid = mid
         self.home = None
@@ -133,16 +250,10 @@ class Score():
         self.stage = stage
                 
         if teams:
-            self.teams = tuple(teams)
-            try:
-                if isinstance(teams[0], tuple):
-                    self.teams = tuple([(fifa_codes[team[0]], team[1]) for team in self.teams])
-                else:
-                    self.teams = tuple([fifa_codes[team] for team in self.teams])
-                if use_code:
-                    self.mid =  self.teams[0] + '.' + self.teams[1]
-            except KeyError:
-                pass
+            codes = team_codes(teams)
+            self.teams = codes or intern(tuple(teams))
+            if use_code and codes:
+                self.mid =  self.teams[0] + '.' + self.teams[1]
 
         if dt:
             self.dt = dt
@@ -165,19 +276,31 @@ class Score():
         if isinstance(score, (list, tuple)) and len(score)==2:
             if (score[0] is None) or (score[1] is None):
                 return
-            self.score = tuple(score)
+            self.score = intern(tuple(score))
             self.home = int(float(score[0]))
             self.away = int(float(score[1]))
         else:
             raise TypeError('unknown score format')
             
         # 1 - home_win; 0 - draw; 2 - away_win
-        self.outcome = outcome
+        if outcome is not None:
+            self.outcome = outcome
         if self.outcome is None:
             self.outcome = (self.home != self.away) + (self.away>self.home)
 
         return 
 
+    @classmethod
+    def shared(cls, *args, **kwargs):
+        '''
+        a Score which may be shared with every other bracket predicting the
+        same, it must not be modified
+        '''
+        key = (args, tuple(sorted(kwargs.items())))
+        score = _shared_scores.get(key)
+        if score is None:
+            score = _shared_scores[key] = cls(*args, **kwargs)
+        return score
         
     def __str__(self):
         if self.score:
@@ -250,6 +373,8 @@ class Score():
 
         
 class Stage():
+    __slots__ = ('name', '_matches', 'teams', 'outcome', 'result', 'qualified', 'ordering', 'questions', '_stats', '_lookup')
+
     def __init__(self, name, matches=None, teams=None, outcome=None, result=None, qualified=None, ordering=None, questions=None):
         '''
         matches - a dict of matches and the corresponding scores scores could be in string or Score format
@@ -257,7 +382,7 @@ class Stage():
         '''
         self.name = name
         self.matches = None
-        self.teams = set()
+        self.teams = frozenset()
         self.outcome = outcome or 0
         self.result = result or 0
         self.qualified = qualified or 0
@@ -278,69 +403,121 @@ class Stage():
                         match_teams += list(match.teams)
                 if match_teams and isinstance(match_teams[0], str):
                     match_teams = [fifa_codes.get(team.title(), team) for team in match_teams]
-                self.teams = set(match_teams) or None
+                # the same for every bracket
+                self.teams = intern(frozenset(match_teams)) or None
         if teams:
             if self.questions:
                 assert len(self.questions) == len(teams)
                 teams = list(zip(teams, self.questions))
-            if isinstance(teams, (list, tuple, set)):
+            if isinstance(teams, (list, tuple, set, frozenset)):
                 if isinstance(list(teams)[0], str):
                     try:
                         teams = tuple([fifa_codes.get(team.title(), team) for team in teams])
                     except KeyError:
                         pass
                 elif isinstance(list(teams)[0], tuple):
-                    teams = tuple([(parse_team(team[0]), team[1])
+                    teams = tuple([intern((parse_team(team[0]), team[1]))
                                     for team in teams])
-                self.teams = set(teams)
+                self.teams = intern(frozenset(teams))
     
             
         
     @property
-    def winners(self):
-        if self.matches:
-            return set([match.winner for match in self.matches.values()])
-        else:
+    def matches(self):
+        return self._matches
+
+    @matches.setter
+    def matches(self, matches):
+        # the statistics and lookups are derived from the scores
+        self._matches = matches
+        self._stats = None
+        self._lookup = None
+
+    @property
+    def stats(self):
+        '''
+        winners and goals of the stage, computed in a single pass over the
+        matches and kept until the matches are replaced
+
+        unplayed matches count towards neither scored nor conceded
+        '''
+        if self._stats is None:
+            winners = set()
+            goals = {}
+            for match in (self._matches or {}).values():
+                winners.add(match.winner)
+                counts = match.goal_count
+                if counts is None:
+                    continue
+                for (team, scored), conceded in zip(counts.items(), reversed(counts.values())):
+                    total = goals.setdefault(team, [0, 0])
+                    total[0] += scored
+                    total[1] += conceded
+            goals = {team: tuple(total) for team, total in goals.items()}
+            scored = Counter({team: total[0] for team, total in goals.items()})
+            conceded = Counter({team: total[1] for team, total in goals.items()})
+            self._stats = {
+                'winners': frozenset(winners) if self._matches else None,
+                'goals': goals,
+                'most_goals_scored': self._leaders(scored),
+                'least_goals_scored': self._leaders(scored, least=True),
+                'most_goals_conceded': self._leaders(conceded),
+            }
+        return self._stats
+
+    @staticmethod
+    def _leaders(count, least=False):
+        if not count:
             return None
+        ranked = count.most_common()
+        if least:
+            ranked = list(reversed(ranked))
+        return [team for team, n in ranked if n == ranked[0][1]]
+
+    @property
+    def goals(self):
+        '''
+        {team: (scored, conceded)} over the played matches of the stage
+        '''
+        return self.stats['goals']
+
+    @property
+    def winners(self):
+        return self.stats['winners']
     
     @property
     def most_goals_scored(self):
-        count = Counter()
-        if self.matches:
-            for match in self.matches.values():
-                count.update(match.goal_count)
-        if len(count):
-            max_count = count.most_common(1)[0][1]
-            return list(c[0] for c in count.most_common() if c[1] == max_count)
-        else:
-            return None
+        return self.stats['most_goals_scored']
             
     @property
     def least_goals_scored(self):
-        count = Counter()
-        if self.matches:
-            for match in self.matches.values():
-                count.update(match.goal_count)
-        if len(count):
-            least_common = list(reversed(count.most_common()))
-            min_count = least_common[0][1]
-            return list(c[0] for c in least_common if c[1] == min_count)
-        else:
-            return None
+        return self.stats['least_goals_scored']
     
     @property
     def most_goals_conceded(self):
-        count = Counter()
-        if self.matches:
-            for match in self.matches.values():
-                gs = match.goal_count
-                goals_conceded = dict(zip(gs.keys(), reversed(list(gs.values()))))
-                count.update(goals_conceded)
-        if len(count):
-            max_count = count.most_common(1)[0][1]
-            return list(c[0] for c in count.most_common() if c[1] == max_count)
-        else:
-            return None
+        return self.stats['most_goals_conceded']
+
+    @property
+    def lookup(self):
+        '''
+        read only structures for scoring against the stage, built on first use
+        and kept until the matches are replaced
+
+        played - {match id: Score} of the matches with a score
+        complete - whether every match has an outcome
+        teams - the teams as a frozenset
+        names - the team names of (team, position) teams
+        '''
+        if self._lookup is None:
+            matches = self._matches or {}
+            teams = frozenset(self.teams or ())
+            self._lookup = MappingProxyType({
+                'played': MappingProxyType({mid: m for mid, m in matches.items() if m.score is not None}),
+                'complete': all(m.outcome is not None for m in matches.values()),
+                'teams': teams,
+                'names': frozenset(t[0] for t in teams if isinstance(t, tuple)),
+            })
+        return self._lookup
 
     def team_compare(self, other):
         '''
@@ -351,14 +528,13 @@ class Stage():
         pts = 0
         if isinstance(self.teams, (list, tuple)):
             correct_qualified = sum([a==b for a,b in zip(self.teams, other.teams)])
-        elif isinstance(self.teams, set):
-            correct_qualified = len(self.teams.intersection(other.teams))
+        elif isinstance(self.teams, (set, frozenset)):
+            lookup = other.lookup
+            correct_qualified = sum(map(lookup['teams'].__contains__, self.teams))
             
-            if self.teams and self.ordering and isinstance(list(self.teams)[0], tuple):
+            if self.teams and self.ordering and self.lookup['names']:
                 correct_ordering = correct_qualified
-                my_teams = set([t[0] for t in self.teams])
-                other_teams = set([t[0] for t in other.teams])
-                correct_qualified = len(my_teams.intersection(other_teams))
+                correct_qualified = sum(map(lookup['names'].__contains__, self.lookup['names']))
                 pts += correct_ordering * self.ordering
             
         pts += correct_qualified * self.qualified
@@ -369,12 +545,11 @@ class Stage():
     def compute(self, other):
         points = 0
         if self.matches:
-            missing_matches = set(self.matches.keys()) - set(other.matches.keys())
-            #if missing_matches:
-            #    print(f'Warning missing matches! {missing_matches}')
+            played = other.lookup['played']
             for mid, match in self.matches.items():
-                if mid in other.matches:
-                    points += match.compute(other.matches[mid], self.outcome, self.result)
+                result = played.get(mid)
+                if result is not None:
+                    points += match.compute(result, self.outcome, self.result)
         
         if self.teams:
             points += self.team_compare(other)
@@ -384,9 +559,6 @@ class Stage():
     def get_upcoming_scores(self, other, t0, t1):
         matches = {}
         if self.matches:
-            missing_matches = set(self.matches.keys()) - set(other.matches.keys())
-            #if missing_matches:
-            #    print(f'Warning missing matches! {missing_matches}')
             for mid, match in sorted(self.matches.items(), key= lambda x: x[1].dt):
                 other_match = other.matches.get(mid)
                 if other_match and (t0 <= (other_match.dt.date() - datetime.now().date()).days <= t1):
@@ -396,7 +568,7 @@ class Stage():
         
     def get_teams(self):
         if self.teams:
-            if isinstance(self.teams, set):
+            if isinstance(self.teams, (set, frozenset)):
                 teams = sorted(list(self.teams))
             else:
                 teams = list(self.teams)
@@ -410,11 +582,13 @@ class Stage():
             
 class Bracket():
     
-    def __init__(self, name, pid, db, scoring=None, phase=1):
+    def __init__(self, name, pid, db, scoring=None, phase=1, predictions=None):
         '''
         load bracket from excel or pkl
         
         maybe specify name and dir or something along those lines
+
+        predictions - a preloaded Predictions set, the db is queried stage by stage if not given
         '''
         self.name = name
         self.dat = {}
@@ -423,22 +597,29 @@ class Bracket():
         self.db = db
         self.pid = pid
         for stage, scor in self.scoring.items():
-            matches, teams = get_predictions_db(db, self.pid, stage, phase)
+            if predictions is not None:
+                matches, teams = predictions.get(self.pid, stage, phase)
+            else:
+                matches, teams = get_predictions_db(db, self.pid, stage, phase)
             if phase == 2:
                 if stage == 'Winner':
                     self.dat['Winner'] = Stage(name='Winner', teams=self.dat['Final'].winners, **scor)
                 else:
                     if stage == 'Final':
                         if matches:
-                            list(matches.values())[0].teams = tuple(teams)
+                            # the prediction may be shared with other brackets
+                            mid, final = next(iter(matches.items()))
+                            final = copy.copy(final)
+                            final.teams = tuple(teams)
+                            matches = {**matches, mid: final}
                     self.dat[stage] = Stage(name=stage, matches=matches, teams=teams, **scor)
             else:
                 self.dat[stage] = Stage(name=stage, matches=matches, teams=teams, **scor)
         
     @classmethod
-    def load_dual_phase(cls, participant, pid, db, scoring):
-        phase1 = cls(participant, pid, db, scoring, phase=1)
-        phase2 = cls(participant, pid, db, scoring, phase=2)
+    def load_dual_phase(cls, participant, pid, db, scoring, predictions=None):
+        phase1 = cls(participant, pid, db, scoring, phase=1, predictions=predictions)
+        phase2 = cls(participant, pid, db, scoring, phase=2, predictions=predictions)
         return phase1, phase2
         
     def parse_stage(self, stage_name, mids, home_dat, away_dat, use_code=False):
@@ -456,10 +637,8 @@ class Bracket():
         for key, stage in self.dat.items():
             if key in other.dat:
                 pts = stage.compute(other.dat[key])
-                if key == 'Bonus GS':
-                    bonus = other.dat['Group Stage'].matches.values()
-                    if sum([v.outcome is not None for v in bonus]) < len(bonus):
-                        pts = 0
+                if key == 'Bonus GS' and not other.dat['Group Stage'].lookup['complete']:
+                    pts = 0
                 points[(self.phase, key)] = pts
             
         return points
@@ -505,19 +684,148 @@ class ActualBracket(Bracket):
         self.db = db
         self.stages = ['Group Stage','Round of 16','Quarter-Finals','Semi-Finals','Finals','Winner','Bonus GS','Bonus KO']
         self.config = config
+        self.results = {}
+        self.changed = set()
         self.update()
 
     def update(self):
+        '''
+        reload the results, self.changed holds the ids of the matches whose
+        score differs from the previous load
+        '''
         self.dat = get_results_db(self.db, self.config)
         self.dat['Winner'] = Stage('Winner', teams=['Spain'])
-        mgs = product(self.dat['Group Stage'].most_goals_scored, ["Score Most Goals"])
-        mgc = product(self.dat['Group Stage'].most_goals_conceded,[ "Concede Most Goals"])
-        lgs = product(self.dat['Group Stage'].least_goals_scored, ["Score Least Goals"])
-        bonus_gs = list(mgs) + list(lgs) + list(mgc)
-        self.dat['Bonus GS'] = Stage('Bonus GS', teams=bonus_gs)
+        self.dat['Bonus GS'] = self.bonus_gs()
         bonus_ko = [('Rodri','Best Player'),('Yamal','Best Young Player'),('Kane','Top Scorer'),('Turkey','Dark Horse')]
         self.dat['Bonus KO'] = Stage('Bonus KO', teams=bonus_ko)
 
+        results = {mid: match.score for mid, match in self.matches.items()}
+        self.changed = set(mid for mid in results.keys() | self.results.keys()
+                           if results.get(mid) != self.results.get(mid))
+        self.results = results
+        self.alive = self.surviving_teams()
+        self.lookups = self.build_lookups()
+
+    def build_lookups(self):
+        '''
+        the lookups of every stage, built once per version of the results so
+        scoring the participants against them allocates nothing
+        '''
+        return MappingProxyType({name: stage.lookup for name, stage in self.dat.items()})
+
+    def bonus_gs(self):
+        group_stage = self.dat['Group Stage']
+        mgs = product(group_stage.most_goals_scored or (), ["Score Most Goals"])
+        mgc = product(group_stage.most_goals_conceded or (), [ "Concede Most Goals"])
+        lgs = product(group_stage.least_goals_scored or (), ["Score Least Goals"])
+        bonus_gs = list(mgs) + list(lgs) + list(mgc)
+        return Stage('Bonus GS', teams=bonus_gs)
+
+    def find_match(self, key):
+        '''
+        (match id, reversed) of the match given by id or by its (home, away) teams
+        '''
+        matches = self.matches
+        for mid in (key, str(key)) + ((int(key),) if str(key).isdigit() else ()):
+            if mid in matches:
+                return mid, False
+        if isinstance(key, (list, tuple)) and len(key) == 2:
+            teams = tuple(parse_team(team) for team in key)
+            found = [(match.score is not None, match.dt or datetime.max, str(mid), mid, match.teams == teams[::-1])
+                     for mid, match in matches.items() if match.teams in (teams, teams[::-1])]
+            if found:
+                # teams may meet twice, the next match between them is meant
+                return min(found)[3:]
+        raise KeyError(f'unknown match {key}')
+
+    def with_scores(self, scores):
+        '''
+        a copy of the bracket with hypothetical results, self is left untouched
+
+        scores - {match id or (home, away) teams: score} in any format Score accepts
+        the stages which are not affected are shared with self
+        '''
+        hypothetical = {}
+        for key, score in scores.items():
+            mid, flip = self.find_match(key)
+            match = self.matches[mid]
+            new = Score(mid, score, dt=match.dt, stage=match.stage)
+            if new.score is not None:
+                home, away, outcome = new.home, new.away, new.outcome
+                if flip:
+                    home, away, outcome = away, home, {1: 2, 2: 1}.get(outcome, outcome)
+                new = Score(mid, (home, away), dt=match.dt, stage=match.stage, outcome=outcome)
+            # set afterwards as the constructor would map codes back to names
+            new.teams = match.teams
+            hypothetical[mid] = new
+
+        actual = copy.copy(self)
+        actual.dat = dict(self.dat)
+        for name, stage in self.dat.items():
+            if not stage.matches or not hypothetical.keys() & stage.matches.keys():
+                continue
+            stage = copy.copy(stage)
+            stage.matches = {mid: hypothetical.get(mid, m) for mid, m in stage.matches.items()}
+            actual.dat[name] = stage
+            if name == 'Group Stage':
+                actual.dat['Bonus GS'] = actual.bonus_gs()
+            elif name == 'Final':
+                winners = [m.winner for m in stage.matches.values() if m.winner]
+                if winners:
+                    actual.dat['Winner'] = Stage('Winner', teams=winners)
+        actual.changed = set(hypothetical)
+        actual.results = {mid: match.score for mid, match in actual.matches.items()}
+        actual.alive = actual.surviving_teams()
+        actual.lookups = actual.build_lookups()
+        return actual
+
+    @property
+    def group_complete(self):
+        return self.dat['Group Stage'].lookup['complete']
+
+    def surviving_teams(self):
+        '''
+        teams still in the tournament: those in the latest knockout round
+        whose teams are all known, less the losers of the knockout matches
+        '''
+        alive = set(self.dat['Group Stage'].teams or ())
+        for name in KNOCKOUT_STAGES:
+            stage = self.dat.get(name)
+            if not stage or not stage.matches:
+                continue
+            if self.settled(name):
+                alive &= set(team for match in stage.matches.values() for team in match.teams)
+            for match in stage.matches.values():
+                if match.winner and match.teams:
+                    alive.discard(match.teams[2 - match.outcome])
+        return alive
+
+    def settled(self, name):
+        '''
+        True once the teams of stage name are known for certain
+        '''
+        if name == 'Bonus GS':
+            return self.group_complete
+        if name == 'Winner':
+            final = self.dat.get('Final')
+            return not (final and final.matches) or all(match.winner for match in final.matches.values())
+        if name in KNOCKOUT_STAGES:
+            stage = self.dat.get(name)
+            group_teams = self.dat['Group Stage'].teams or ()
+            return bool(stage and stage.matches) and all(
+                match.teams and all(team in group_teams for team in match.teams) for match in stage.matches.values())
+        # the remaining answers are entered by hand
+        return True
+
+    def alive_pick(self, name, pick):
+        '''
+        whether a team pick for stage name can still come true
+        '''
+        if name not in KNOCKOUT_STAGES and name != 'Winner':
+            return True
+        team = pick[0] if isinstance(pick, tuple) else pick
+        return isinstance(team, str) and (team in self.alive or parse_team(team) in self.alive)
+
 
             
 class Tournament():
@@ -527,86 +835,266 @@ class Tournament():
         self.db = db
         self.participants = {}
         self.brackets = {}
+        self.engines = {}
         self.scoring = config['scoring']
         self.config = config
+        # the live change listener reloads from its own thread
+        self.lock = threading.RLock()
 
-        competitions = self.db.get('competition', 'id, description')
-        if not isinstance(competitions[0], tuple):
-            competitions = (competitions,)
-        self.competitions = {cid:comp for cid, comp in competitions}
-        for cid, comp in self.competitions.items():
-            participants = self.db.get('participant','id, name', competition_id=cid)
-            self.participants[cid] = {p_name.title(): pid for pid, p_name in participants}
+        # predictions are frozen after each deadline so reuse the on-disk
+        # snapshot for as long as the prediction tables are unchanged
+        self.snapshot_key = snapshot_key(db, config)
+        snapshot = load_snapshot(name, self.snapshot_key)
+        if snapshot is None:
+            snapshot = self.load_predictions()
+            save_snapshot(name, self.snapshot_key, snapshot)
+        self.competitions = snapshot['competitions']
+        self.participants = snapshot['participants']
 
+        for cid, comp in self.competitions.items():
             self.brackets[cid] = {}
+            predictions = snapshot['predictions'][cid]
             for participant, pid in self.participants[cid].items():
-                self.brackets[cid][participant] = Bracket.load_dual_phase(participant, pid, db, scoring=self.scoring)
+                self.brackets[cid][participant] = Bracket.load_dual_phase(participant, pid, db, scoring=self.scoring,
+                                                                          predictions=predictions)
                 print('loaded bracket for:', comp, participant)
 
+            names = [re.sub(r"(\w)([A-Z])", r"\1 \2", name) for name in self.brackets[cid]]
+            self.engines[cid] = ScoringEngine(names, self.brackets[cid].values())
+
         self.load_time = 0
         self.load_interval = load 
         self.update_time = time.time()
         self.update_interval = update 
+        self.version = None
+        self.history = StandingsHistory(name)
         self.reload()
 
+    def load_predictions(self):
+        '''
+        read the competitions, their participants and all their predictions from the db
+        '''
+        competitions = self.db.get('competition', 'id, description')
+        if not isinstance(competitions[0], tuple):
+            competitions = (competitions,)
+        competitions = {cid:comp for cid, comp in competitions}
+        participants = {}
+        predictions = {}
+        for cid, comp in competitions.items():
+            rows = self.db.get('participant','id, name', competition_id=cid)
+            participants[cid] = {p_name.title(): pid for pid, p_name in rows}
+            predictions[cid] = Predictions.from_db(self.db, cid)
+
+        return {'competitions': competitions, 'participants': participants, 'predictions': predictions}
     
-    def reload(self):
-        current_time = time.time()
-        if current_time - self.load_time > self.load_interval:
-            self.actual = ActualBracket(self.db, self.config)
-            self.teams = self.actual.dat['Group Stage'].teams
-            self.load_time = current_time
-        elif current_time - self.update_time > self.update_interval:
-            self.actual.update()
-            self.update_time = current_time
-        
+    @timed('tournament_seconds', step='reload')
+    def reload(self, force=False):
+        '''
+        force - re-read the results now rather than waiting for update_interval,
+                used when a poller reports a score change
+        '''
+        with self.lock:
+            current_time = time.time()
+            if current_time - self.load_time > self.load_interval:
+                self.actual = ActualBracket(self.db, self.config)
+                self.teams = self.actual.dat['Group Stage'].teams
+                self.load_time = current_time
+                for engine in self.engines.values():
+                    engine.reset()
+            elif force or current_time - self.update_time > self.update_interval:
+                self.actual.update()
+                self.update_time = current_time
+                for engine in self.engines.values():
+                    engine.mark_changed(self.actual.changed)
+            version = self.data_version()
+            if version != self.version:
+                self.version = version
+                self.record_history()
+
+    def record_history(self):
+        '''
+        append the standings at the current version to the history, every
+        stage is kept so the layout does not change as stages get results
+        '''
+        for cid, engine in self.engines.items():
+            df = self.competition_standings(cid)
+            df = df.reindex(columns=pd.MultiIndex.from_tuples(engine.columns), fill_value=0)
+            try:
+                self.history.append(cid, self.version, engine.names, engine.columns, df.values)
+            except OSError as e:
+                print('unable to record the standings history:', e)
+
+    def data_version(self):
+        '''
+        digest of the predictions and results everything displayed is derived
+        from, the same in every worker holding the same data
+        '''
+        fixtures = sorted((str(mid), match.teams, match.score, match.dt) for mid, match in self.actual.matches.items())
+        return hashlib.sha1(repr((self.snapshot_key, fixtures)).encode()).hexdigest()[:16]
+
+    @timed('tournament_seconds', step='standings')
+    def competition_standings(self, cid):
+        with self.lock:
+            return self.engines[cid].compute(self.actual)
+
+    def what_if(self, scores):
+        '''
+        standings of every competition if the matches in scores ended that way
+
+        scores - {match id or (home, away) teams: score}, e.g. {('ESP', 'ENG'): '2-1'}
+        neither the db nor self.actual are touched, only the hypothetical
+        matches and the stages depending on them are rescored
+        '''
+        with self.lock:
+            actual = self.actual.with_scores(scores)
+            res = {}
+            for cid, comp in self.competitions.items():
+                engine = self.engines[cid]
+                engine.compute(self.actual)
+                res[comp] = engine.what_if(actual, actual.changed)
+        return res
+
+    def competition_max_points(self, cid):
+        with self.lock:
+            return self.engines[cid].max_points(self.actual)
+
+    def competition_elimination(self, cid):
+        '''
+        current and maximum attainable totals of every participant, flagging
+        those who can no longer catch the leader or the last prize place
+        '''
+        with self.lock:
+            total = self.competition_standings(cid).sum(axis=1)
+            most = self.competition_max_points(cid).sum(axis=1)
+        prizes = self.config.get('simulation', {}).get('prizes', 2)
+        ranked = total.sort_values(ascending=False).tolist() or [0]
+        # nobody can finish below what they already have
+        most = most.clip(lower=total)
+        res = pd.DataFrame({'Total': total, 'Max': most})
+        res['Eliminated'] = most < ranked[0]
+        res['Out of Prizes'] = most < ranked[min(prizes, len(ranked)) - 1]
+        return res
 
     @property
     def standings(self):
         res = {}
         for cid, comp in self.competitions.items():
-            points = {}
-            for name, (phase1, phase2) in self.brackets[cid].items():
-                name = re.sub(r"(\w)([A-Z])", r"\1 \2", name)
-                points[name] = {}
-                points[name].update(phase1.compute(self.actual))
-                points[name].update(phase2.compute(self.actual))
-
-            points = pd.DataFrame.from_dict(points, orient='index')
-            res[comp] = points
+            res[comp] = self.competition_standings(cid)
         
         return res
+
+    @timed('tournament_seconds', step='predicted_scores')
+    def competition_predicted_scores(self, cid, t0, t1):
+        scores = {}
+        for name, (phase1, phase2) in self.brackets[cid].items():
+            name = re.sub(r"(\w)([A-Z])", r"\1 \2", name)
+            scores[name] = phase1.get_upcoming_scores(self.actual, t0, t1)
+            scores[name].update(phase2.get_upcoming_scores(self.actual, t0, t1))
+        return pd.DataFrame.from_dict(scores).T.sort_index()
     
     def predicted_scores(self, t0, t1):
         res = {}
         for cid, comp in self.competitions.items():
-            scores = {}
-            for name, (phase1, phase2) in self.brackets[cid].items():
-                name = re.sub(r"(\w)([A-Z])", r"\1 \2", name)
-                scores[name] = phase1.get_upcoming_scores(self.actual, t0, t1)
-                scores[name].update(phase2.get_upcoming_scores(self.actual, t0, t1))
-            scores = pd.DataFrame.from_dict(scores).T.sort_index()
-            res[comp] = scores
+            res[comp] = self.competition_predicted_scores(cid, t0, t1)
         
         return res
 
+    @timed('tournament_seconds', step='predicted_teams')
+    def competition_predicted_teams(self, cid):
+        teams = {}
+        for name, (phase1, phase2) in self.brackets[cid].items():
+            name = re.sub(r"(\w)([A-Z])", r"\1 \2", name)
+            teams[name] = {}
+            if phase1.teams:
+                teams[name].update(phase1.get_teams())
+            if phase2.teams:
+                teams[name].update(phase2.get_teams())
+        return pd.DataFrame.from_dict(teams, orient='index').sort_index()
+
     @property
     def predicted_teams(self):
         res = {}
         for cid, comp in self.competitions.items():
-            teams = {}
-            for name, (phase1, phase2) in self.brackets[cid].items():
-                name = re.sub(r"(\w)([A-Z])", r"\1 \2", name)
-                teams[name] = {}
-                if phase1.teams:
-                    teams[name].update(phase1.get_teams())
-                if phase2.teams:
-                    teams[name].update(phase2.get_teams())
-            teams = pd.DataFrame.from_dict(teams, orient='index').sort_index()
-            res[comp] = teams
+            res[comp] = self.competition_predicted_teams(cid)
 
         return res
 
+    def competition_consensus(self, cid):
+        '''
+        share of the participants picking each team per stage and the most
+        common score and outcome split of each match, see ScoringEngine.consensus
+        '''
+        consensus = self.engines[cid].consensus()
+        with self.lock:
+            matches = consensus['matches'].copy()
+            fixtures = self.actual.matches
+            matches.insert(0, 'Matchup', [fixtures[mid].matchup if mid in fixtures else None
+                                          for mid in matches.index.get_level_values('Match')])
+        return {'teams': consensus['teams'], 'matches': matches}
+
+    @property
+    def consensus(self):
+        res = {}
+        for cid, comp in self.competitions.items():
+            res[comp] = self.competition_consensus(cid)
+        return res
+
+    @property
+    def team_stages(self):
+        '''
+        (phase, stage) of every stage with team predictions, in bracket order
+        '''
+        stages = []
+        for engine in self.engines.values():
+            stages += [engine.columns[team_stage['column']] for team_stage in engine.team_stages]
+        return list(dict.fromkeys(stages))
+
+
+class LazyTournament():
+    '''
+    builds the Tournament in a background thread so web workers boot and
+    answer health checks straight away while the predictions load
+    '''
+
+    def __init__(self, name, db, config, retry=30):
+        self.name = name
+        self.db = db
+        self.config = config
+        self.retry = retry
+        self.tournament = None
+        self.error = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.load, name='tournament-warmup', daemon=True)
+                self.thread.start()
+        return self
+
+    def load(self):
+        started = time.time()
+        while self.tournament is None:
+            try:
+                self.tournament = Tournament(self.name, self.db, self.config)
+                self.error = None
+            except Exception as e:
+                self.error = repr(e)
+                print(f'failed to load tournament, retrying in {self.retry}s:', e)
+                time.sleep(self.retry)
+        print(f'loaded tournament in {time.time() - started:.1f}s')
+        self.ready.set()
+
+    def get(self, timeout=0):
+        '''
+        the tournament, or None if it is not loaded within timeout seconds
+        '''
+        self.start()
+        self.ready.wait(timeout)
+        return self.tournament
+
 if __name__ == '__main__':
     from util import config, DB
     db = DB(config['sql'])
@@ -55,6 +55,12 @@ CREATE TABLE `score` (
   `source` varchar(255)
 );
 
+CREATE TABLE `change_log` (
+  `id` int PRIMARY KEY AUTO_INCREMENT,
+  `match_id` int NOT NULL,
+  `created_at` timestamp NOT NULL DEFAULT (now())
+);
+
 CREATE UNIQUE INDEX `participant_index_0` ON `participant` (`email`, `competition_id`);
 
 CREATE INDEX `match_id_index` ON `match_prediction` (`match_id`);
@@ -76,3 +82,5 @@ ALTER TABLE `team_prediction` ADD FOREIGN KEY (`participant_id`) REFERENCES `par
 ALTER TABLE `match_prediction` ADD FOREIGN KEY (`match_id`) REFERENCES `fixtures` (`id`);
 
 ALTER TABLE `score` ADD FOREIGN KEY (`match_id`) REFERENCES `fixtures` (`id`);
+
+ALTER TABLE `change_log` ADD FOREIGN KEY (`match_id`) REFERENCES `fixtures` (`id`);
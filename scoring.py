@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pandas as pd
+
+# marker for a missing prediction or a match which has not been played yet
+MISSING = -1
+
+
+class ScoringEngine():
+    '''
+    Scores every bracket of a competition against the actual results in a
+    handful of array operations.
+
+    Match predictions are packed into participants x match-slots arrays (one
+    slot per predicted match per stage) and qualifier predictions into
+    participants x team-slots membership matrices, one per stage.
+    The output has the same (phase, stage) column layout as Bracket.compute.
+    '''
+
+    def __init__(self, names, brackets):
+        '''
+        names - display name of each participant
+        brackets - the (phase1, phase2) brackets of each participant, in the same order as names
+        '''
+        self.names = list(names)
+        rows = []
+        for phases in brackets:
+            row = {}
+            for bracket in phases:
+                for key, stage in bracket.dat.items():
+                    row[(bracket.phase, key)] = stage
+            rows.append(row)
+        self.columns = list(dict.fromkeys(col for row in rows for col in row))
+        self._pack_matches(rows)
+        self._pack_teams(rows)
+        self._consensus = None
+        self.reset()
+
+    def _pack_matches(self, rows):
+        slots = []
+        for c, col in enumerate(self.columns):
+            mids = dict.fromkeys(mid for row in rows if col in row and row[col].matches
+                                 for mid in row[col].matches)
+            slots += [(c, mid) for mid in mids]
+        self.slots = slots
+        index = {slot: j for j, slot in enumerate(slots)}
+        self._mid_slots = {}
+        for j, (_, mid) in enumerate(slots):
+            self._mid_slots.setdefault(mid, []).append(j)
+
+        shape = (len(rows), len(slots))
+        self.home = np.full(shape, MISSING, dtype=np.int16)
+        self.away = np.full(shape, MISSING, dtype=np.int16)
+        self.outcome = np.full(shape, MISSING, dtype=np.int16)
+        for p, row in enumerate(rows):
+            for c, col in enumerate(self.columns):
+                stage = row.get(col)
+                if stage is None or not stage.matches:
+                    continue
+                for mid, match in stage.matches.items():
+                    if match.score is None:
+                        continue
+                    j = index[(c, mid)]
+                    self.home[p, j] = match.home
+                    self.away[p, j] = match.away
+                    self.outcome[p, j] = match.outcome
+        self.predicted = self.home != MISSING
+
+        # points on offer for each slot and a slot -> column map to sum them up
+        weights = [self._stage_weights(rows, col) for col in self.columns]
+        self.result_points = np.array([weights[c]['result'] for c, _ in slots], dtype=np.int64)
+        self.outcome_points = np.array([weights[c]['outcome'] for c, _ in slots], dtype=np.int64)
+        self.slot_columns = np.zeros((len(slots), len(self.columns)), dtype=np.int64)
+        for j, (c, _) in enumerate(slots):
+            self.slot_columns[j, c] = 1
+        # the most each slot can still give, an exact score is possible until the match is played
+        self.slot_potential = self.predicted * self.result_points
+
+    def _pack_teams(self, rows):
+        '''
+        one membership matrix per stage with a column for every team (or
+        (team, position) pair) picked by at least one participant
+        '''
+        self.team_stages = []
+        for c, col in enumerate(self.columns):
+            picks = [row[col].teams if col in row and row[col].teams else None for row in rows]
+            if not any(picks):
+                continue
+            weights = self._stage_weights(rows, col)
+            ordered = np.array([bool(t) and bool(weights['ordering']) and isinstance(next(iter(t)), tuple)
+                                for t in picks])
+            keys = list(dict.fromkeys(t for teams in picks if teams for t in teams))
+            names = list(dict.fromkeys(t[0] for teams, o in zip(picks, ordered) if o for t in teams))
+            key_index = {k: i for i, k in enumerate(keys)}
+            name_index = {n: i for i, n in enumerate(names)}
+            teams = np.zeros((len(rows), len(keys)), dtype=np.int64)
+            team_names = np.zeros((len(rows), len(names)), dtype=np.int64)
+            for p, (t, o) in enumerate(zip(picks, ordered)):
+                if not t:
+                    continue
+                for team in t:
+                    teams[p, key_index[team]] = 1
+                    if o:
+                        team_names[p, name_index[team[0]]] = 1
+            self.team_stages.append({
+                'column': c,
+                'keys': keys,
+                'names': names,
+                'teams': teams,
+                'team_names': team_names,
+                'ordered': ordered,
+                'qualified': weights['qualified'],
+                'ordering': weights['ordering'],
+                'questions': weights['questions'],
+            })
+
+    @staticmethod
+    def _stage_weights(rows, col):
+        for row in rows:
+            if col in row:
+                stage = row[col]
+                return {'outcome': stage.outcome, 'result': stage.result,
+                        'qualified': stage.qualified, 'ordering': stage.ordering,
+                        'questions': stage.questions}
+
+    def consensus(self):
+        '''
+        aggregates over every participant's picks:
+        teams - (phase, stage, question, team) x picks, share of the participants with picks
+                in the stage, the question is missing outside the bonus stages
+        matches - (phase, stage, match id) x predictions, most common score and its share,
+                  share of predicted home wins, draws and away wins
+
+        the predictions do not change during the engine's life so they are computed once
+        '''
+        if self._consensus is None:
+            self._consensus = {'teams': self._team_consensus(), 'matches': self._match_consensus()}
+        return self._consensus
+
+    def _team_consensus(self):
+        rows, picks, shares, order = [], [], [], []
+        for s, team_stage in enumerate(self.team_stages):
+            if not team_stage['qualified'] and not team_stage['ordering']:
+                # teams taken from the predicted matches, nobody picked them
+                continue
+            keys = team_stage['keys']
+            if team_stage['questions']:
+                # (team, question) keys, a team's popularity is per question
+                rank = {q: i for i, q in enumerate(team_stage['questions'])}
+                answer = lambda key: (key[1], key[0])
+                answers = sorted(dict.fromkeys(answer(k) for k in keys if k[0] is not None),
+                                 key=lambda a: rank.get(a[0], len(rank)))
+            else:
+                # a team picked for several positions counts once per participant
+                rank = {None: 0}
+                answer = lambda key: (None, key[0] if isinstance(key, tuple) else key)
+                answers = list(dict.fromkeys(a for a in map(answer, keys) if a[1] is not None))
+            index = {a: i for i, a in enumerate(answers)}
+            key_answers = np.zeros((len(keys), len(answers)), dtype=np.int64)
+            for k, key in enumerate(keys):
+                # picks without a team, e.g. the winner of a predicted draw, are not counted
+                if answer(key) in index:
+                    key_answers[k, index[answer(key)]] = 1
+            picked = (team_stage['teams'] @ key_answers) > 0
+            entrants = max(int(team_stage['teams'].any(axis=1).sum()), 1)
+            phase, stage = self.columns[team_stage['column']]
+            counts = picked.sum(axis=0)
+            rows += [(phase, stage, question, team) for question, team in answers]
+            picks += counts.tolist()
+            shares += (counts / entrants).tolist()
+            order += [(s, rank.get(question, len(rank))) for question, _ in answers]
+        index = pd.MultiIndex.from_tuples(rows, names=['Phase', 'Stage', 'Question', 'Team'])
+        res = pd.DataFrame({'Picks': picks, 'Share': shares}, index=index)
+        if not rows:
+            return res
+        # stages in bracket order and their questions in order, most picked teams first
+        stages, questions = zip(*order)
+        return res.iloc[np.lexsort((-np.array(picks, dtype=np.int64), questions, stages))]
+
+    def _match_consensus(self):
+        S = len(self.slots)
+        predictions = self.predicted.sum(axis=0)
+        G = int(max(self.home.max(initial=0), self.away.max(initial=0))) + 1
+        slot = np.broadcast_to(np.arange(S), self.home.shape)[self.predicted]
+        scores = np.bincount((slot * G + self.home[self.predicted]) * G + self.away[self.predicted],
+                             minlength=S * G * G).reshape(S, G * G)
+        outcomes = np.bincount(slot * 3 + self.outcome[self.predicted], minlength=S * 3).reshape(S, 3)
+        top = scores.argmax(axis=1)
+        total = np.maximum(predictions, 1)
+        index = pd.MultiIndex.from_tuples([self.columns[c] + (mid,) for c, mid in self.slots],
+                                          names=['Phase', 'Stage', 'Match'])
+        return pd.DataFrame({
+            'Predictions': predictions,
+            'Top Score': [f'{h}-{a}' if n else None for h, a, n in zip(top // G, top % G, predictions)],
+            'Top Score Share': scores[np.arange(S), top] / total,
+            'Home': outcomes[:, 1] / total,
+            'Draw': outcomes[:, 0] / total,
+            'Away': outcomes[:, 2] / total,
+        }, index=index)
+
+    def actual_scores(self, actual, slots=None):
+        '''
+        home, away and outcome vectors of the actual results aligned to the match slots
+        '''
+        if slots is None:
+            slots = range(len(self.slots))
+        home = np.full(len(slots), MISSING, dtype=np.int16)
+        away = np.full(len(slots), MISSING, dtype=np.int16)
+        outcome = np.full(len(slots), MISSING, dtype=np.int16)
+        for i, j in enumerate(slots):
+            c, mid = self.slots[j]
+            stage = actual.dat.get(self.columns[c][1])
+            match = stage.lookup['played'].get(mid) if stage else None
+            if match is None:
+                continue
+            home[i] = match.home
+            away[i] = match.away
+            outcome[i] = match.outcome
+        return home, away, outcome
+
+    def actual_teams(self, team_stage, actual):
+        '''
+        membership vectors of the actual qualified teams aligned to a team stage
+        '''
+        stage = actual.dat.get(self.columns[team_stage['column']][1])
+        if stage is None:
+            teams = names = frozenset()
+        else:
+            teams, names = stage.lookup['teams'], stage.lookup['names']
+        return (np.array([k in teams for k in team_stage['keys']], dtype=np.int64),
+                np.array([n in names for n in team_stage['names']], dtype=np.int64))
+
+    def score_slots(self, home, away, outcome, slots=slice(None)):
+        '''
+        participants x slots points given the actual scores of each slot
+        '''
+        played = (home != MISSING) & self.predicted[:, slots]
+        exact = (self.home[:, slots] == home) & (self.away[:, slots] == away)
+        correct = self.outcome[:, slots] == outcome
+        points = np.where(exact, self.result_points[slots],
+                          np.where(correct, self.outcome_points[slots], 0))
+        return points * played
+
+    def score_teams(self, team_stage, teams, names):
+        '''
+        teams, names - actual membership vectors, or scenarios x keys matrices of them
+        '''
+        correct = teams @ team_stage['teams'].T
+        correct_names = names @ team_stage['team_names'].T
+        return np.where(team_stage['ordered'],
+                        team_stage['ordering'] * correct + team_stage['qualified'] * correct_names,
+                        team_stage['qualified'] * correct)
+
+    def mark_changed(self, mids):
+        '''
+        record match ids whose result changed since the last compute
+        '''
+        if self._pending is not None:
+            self._pending.update(mids)
+
+    def reset(self):
+        '''
+        force a full recompute on the next call to compute
+        '''
+        self._state = None
+        self._pending = None
+
+    def compute(self, actual):
+        '''
+        points of every participant per (phase, stage) against the actual bracket
+
+        only the matches flagged through mark_changed are rescored once a full
+        computation has been done, the running points table is kept in memory.
+        The team stages are diffed on every call as their teams can change
+        without any score changing, e.g. the next round's fixtures filled in
+        '''
+        if self._state is None or self._pending is None:
+            self._state = self._score(actual)
+        else:
+            self._rescore(self._state, actual, self._pending)
+        self._pending = set()
+        return self._frame(self._state['points'], actual)
+
+    def _score(self, actual):
+        home, away, outcome = self.actual_scores(actual)
+        slot_points = self.score_slots(home, away, outcome)
+        state = {
+            'home': home,
+            'away': away,
+            'outcome': outcome,
+            'slot_points': slot_points,
+            'points': slot_points @ self.slot_columns,
+            'remaining': self.slot_potential[:, home == MISSING] @ self.slot_columns[home == MISSING],
+            'teams': [],
+        }
+        for team_stage in self.team_stages:
+            teams, names = self.actual_teams(team_stage, actual)
+            points = self.score_teams(team_stage, teams, names)
+            state['points'][:, team_stage['column']] += points
+            state['teams'].append({'teams': teams, 'names': names, 'points': points})
+        return state
+
+    def _rescore(self, state, actual, mids):
+        '''
+        apply the point deltas of the changed matches (and of any team stage
+        whose actual teams changed as a result) to state in place
+        '''
+        slots = [j for mid in mids for j in self._mid_slots.get(mid, ())]
+        if slots:
+            home, away, outcome = self.actual_scores(actual, slots)
+            opened = (home == MISSING).astype(np.int64) - (state['home'][slots] == MISSING)
+            state['remaining'] += (self.slot_potential[:, slots] * opened) @ self.slot_columns[slots]
+            state['home'][slots] = home
+            state['away'][slots] = away
+            state['outcome'][slots] = outcome
+            points = self.score_slots(home, away, outcome, slots)
+            delta = points - state['slot_points'][:, slots]
+            state['slot_points'][:, slots] = points
+            state['points'] += delta @ self.slot_columns[slots]
+
+        for team_stage, current in zip(self.team_stages, state['teams']):
+            teams, names = self.actual_teams(team_stage, actual)
+            if np.array_equal(teams, current['teams']) and np.array_equal(names, current['names']):
+                continue
+            points = self.score_teams(team_stage, teams, names)
+            state['points'][:, team_stage['column']] += points - current['points']
+            current.update(teams=teams, names=names, points=points)
+        return state
+
+    def what_if(self, actual, mids):
+        '''
+        points per (phase, stage) against a hypothetical bracket differing from
+        the last computed one in the matches mids
+
+        the deltas are applied to a copy of the running points, the state
+        itself is left as it is
+        '''
+        state = self._state
+        points = state['points'].copy()
+        slots = [j for mid in mids for j in self._mid_slots.get(mid, ())]
+        if slots:
+            home, away, outcome = self.actual_scores(actual, slots)
+            delta = self.score_slots(home, away, outcome, slots) - state['slot_points'][:, slots]
+            points += delta @ self.slot_columns[slots]
+        for team_stage, current in zip(self.team_stages, state['teams']):
+            teams, names = self.actual_teams(team_stage, actual)
+            if np.array_equal(teams, current['teams']) and np.array_equal(names, current['names']):
+                continue
+            points[:, team_stage['column']] += self.score_teams(team_stage, teams, names) - current['points']
+        return self._frame(points, actual)
+
+    def max_points(self, actual):
+        '''
+        the most every participant can still finish with per (phase, stage)
+
+        unplayed matches count as exact results and the qualifier stages the
+        actual bracket has not settled count every pick which is still alive,
+        but never less than the points they already give. Both are kept up to
+        date with the incremental state, a team stage is only rescored when
+        its settled flag or set of live picks changes. Stages without any
+        results yet are included as well
+        '''
+        self.compute(actual)
+        state = self._state
+        points = state['points'] + state['remaining']
+        for team_stage, current in zip(self.team_stages, state['teams']):
+            name = self.columns[team_stage['column']][1]
+            if actual.settled(name):
+                continue
+            keys = np.array([actual.alive_pick(name, k) for k in team_stage['keys']], dtype=np.int64)
+            names = np.array([actual.alive_pick(name, n) for n in team_stage['names']], dtype=np.int64)
+            cached = current.get('potential')
+            if cached is None or not (np.array_equal(keys, cached[0]) and np.array_equal(names, cached[1])):
+                current['potential'] = (keys, names, self.score_teams(team_stage, keys, names))
+            potential = np.maximum(current['potential'][2], current['points'])
+            points[:, team_stage['column']] += potential - current['points']
+        return self._frame(points, actual, hide_bonus=False, every_stage=True)
+
+    def _frame(self, points, actual, hide_bonus=True, every_stage=False):
+        cols = [c for c, (phase, stage) in enumerate(self.columns) if every_stage or stage in actual.dat]
+        points = points[:, cols]
+        complete = 'Group Stage' in actual.dat and actual.dat['Group Stage'].lookup['complete']
+        for i, c in enumerate(cols):
+            if self.columns[c][1] == 'Bonus GS' and not complete and hide_bonus:
+                points[:, i] = 0
+        if not cols:
+            return pd.DataFrame(index=self.names)
+        columns = pd.MultiIndex.from_tuples([self.columns[c] for c in cols])
+        return pd.DataFrame(points, index=self.names, columns=columns)
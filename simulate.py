@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from teams import fifa_codes
+from predictor import KNOCKOUT_STAGES
+
+BONUS_QUESTIONS = ['Score Most Goals', 'Score Least Goals', 'Concede Most Goals']
+
+# cells of the gathered participants x slots x scenarios points per chunk
+CHUNK_CELLS = 20_000_000
+
+
+class Simulator():
+    '''
+    Monte Carlo estimate of where every participant of a competition finishes.
+
+    Unplayed matches get independent Poisson scores, knockout draws are
+    settled by a coin toss and the knockout path follows from the sampled
+    winners. Each scenario is scored with the participants' ScoringEngine
+    arrays: played matches and settled stages are scored once, an unplayed
+    match is a lookup into a table of the points every participant gets for
+    each possible score, and qualifier stages are membership matrix products.
+
+    Where the fixtures do not name the teams yet the bracket is filled in
+    order: winners of consecutive fixtures meet in the next round and the
+    Round of 16 pairs group winners with the other qualifiers from the
+    simulated group tables (the exact draw is not modelled).
+
+    Only arrays are kept so the simulator can be shipped to worker processes.
+    '''
+
+    def __init__(self, engine, actual, config, goals=1.3, prizes=2, max_goals=10):
+        self.names = list(engine.names)
+        self.goals = goals
+        self.prizes = prizes
+        self.max_goals = max_goals
+        self._index_teams(actual, config)
+        self._index_fixtures(actual)
+        self._pack_slots(engine, actual)
+        self._pack_team_stages(engine, actual)
+
+    @classmethod
+    def from_tournament(cls, tournament, cid, **kwargs):
+        settings = {k: v for k, v in tournament.config.get('simulation', {}).items()
+                    if k in ('goals', 'prizes', 'max_goals')}
+        settings.update(kwargs)
+        with tournament.lock:
+            return cls(tournament.engines[cid], tournament.actual, tournament.config, **settings)
+
+    def _index_teams(self, actual, config):
+        groups = config.get('groups', {})
+        self.group_names = list(groups)
+        self.teams = []
+        self.team_group = []
+        for g, members in enumerate(groups.values()):
+            for team in members:
+                self.teams.append(fifa_codes.get(team, team))
+                self.team_group.append(g)
+        self.team_index = {team: t for t, team in enumerate(self.teams)}
+        self.team_group = np.array(self.team_group, dtype=np.int64)
+
+        # positions the actual bracket uses once the group stage is over
+        self.config_labels = np.full(len(self.teams), -1, dtype=np.int64)
+        for team, order in config.get('group_order', {}).items():
+            t = self.team_index.get(fifa_codes.get(team, team))
+            if t is not None:
+                self.config_labels[t] = self.team_group[t] * 10 + order
+
+    def _team(self, team):
+        '''
+        index of a team given by code or by name, -1 if it is not in a group
+        '''
+        if team in self.team_index:
+            return self.team_index[team]
+        return self.team_index.get(fifa_codes.get(team, team), -1)
+
+    def _index_fixtures(self, actual):
+        self.stages = ['Group Stage'] + [s for s in KNOCKOUT_STAGES if s in actual.dat and actual.dat[s].matches]
+        fixtures = []
+        for k, name in enumerate(self.stages):
+            stage = actual.dat.get(name)
+            if not stage or not stage.matches:
+                continue
+            for mid, match in sorted(stage.matches.items(), key=lambda x: (x[1].dt, str(x[0]))):
+                teams = match.teams or (None, None)
+                fixtures.append((k, name, mid, self._team(teams[0]), self._team(teams[1]), match))
+        self.fixture_index = {(name, mid): f for f, (_, name, mid, _, _, _) in enumerate(fixtures)}
+        self.fixture_stage = np.array([f[0] for f in fixtures], dtype=np.int64)
+        self.fixture_home = np.array([f[3] for f in fixtures], dtype=np.int64)
+        self.fixture_away = np.array([f[4] for f in fixtures], dtype=np.int64)
+        self.played = np.array([f[5].score is not None for f in fixtures], dtype=bool)
+        self.home_goals = np.array([f[5].home if f[5].score is not None else 0 for f in fixtures], dtype=np.int64)
+        self.away_goals = np.array([f[5].away if f[5].score is not None else 0 for f in fixtures], dtype=np.int64)
+        self.outcome = np.array([f[5].outcome if f[5].score is not None else 0 for f in fixtures], dtype=np.int64)
+
+        self.group_fixtures = np.flatnonzero(self.fixture_stage == 0)
+        self.group_complete = bool(self.played[self.group_fixtures].all())
+        T = len(self.teams)
+        self.home_incidence = np.zeros((len(self.group_fixtures), T), dtype=np.int64)
+        self.away_incidence = np.zeros((len(self.group_fixtures), T), dtype=np.int64)
+        for i, f in enumerate(self.group_fixtures):
+            if self.fixture_home[f] >= 0 and self.fixture_away[f] >= 0:
+                self.home_incidence[i, self.fixture_home[f]] = 1
+                self.away_incidence[i, self.fixture_away[f]] = 1
+
+    def _pack_slots(self, engine, actual):
+        '''
+        points of the played matches are fixed, every unplayed match gets a
+        (score, penalty winner) x participants points table
+        '''
+        home, away, outcome = engine.actual_scores(actual)
+        self.fixed = engine.score_slots(home, away, outcome).sum(axis=1)
+
+        G = self.max_goals + 1
+        combos = np.arange(G * G * 2)
+        combo_home = combos // (2 * G)
+        combo_away = (combos // 2) % G
+        combo_winner = combos % 2 + 1
+        slots, tables = [], []
+        for j, (c, mid) in enumerate(engine.slots):
+            name = engine.columns[c][1]
+            f = self.fixture_index.get((name, mid))
+            if f is None or self.played[f]:
+                continue
+            decided = np.where(combo_home > combo_away, 1, 2)
+            if self.fixture_stage[f] == 0:
+                combo_outcome = np.where(combo_home == combo_away, 0, decided)
+            else:
+                combo_outcome = np.where(combo_home == combo_away, combo_winner, decided)
+            exact = (engine.home[:, j] == combo_home[:, None]) & (engine.away[:, j] == combo_away[:, None])
+            correct = engine.outcome[:, j] == combo_outcome[:, None]
+            points = np.where(exact, engine.result_points[j], np.where(correct, engine.outcome_points[j], 0))
+            tables.append((points * engine.predicted[:, j]).astype(np.int16))
+            slots.append(f)
+        self.slot_fixtures = np.array(slots, dtype=np.int64)
+        P = len(self.names)
+        self.tables = np.stack(tables) if tables else np.zeros((0, G * G * 2, P), dtype=np.int16)
+
+    def _pack_team_stages(self, engine, actual):
+        '''
+        qualifier stages decided by the simulated matches are re-scored per
+        scenario, the others (e.g. Bonus KO) are fixed
+        '''
+        self.team_stages = []
+        for team_stage in engine.team_stages:
+            name = engine.columns[team_stage['column']][1]
+            if name in self.stages:
+                kind = 'stage'
+            elif name == 'Winner' and 'Final' in self.stages:
+                kind = 'winner'
+            elif name == 'Bonus GS' and len(self.group_fixtures):
+                kind = 'bonus'
+            else:
+                teams, names = engine.actual_teams(team_stage, actual)
+                self.fixed = self.fixed + engine.score_teams(team_stage, teams, names)
+                continue
+            key_team, key_label = [], []
+            for key in team_stage['keys']:
+                team, label = key if isinstance(key, tuple) else (key, None)
+                key_team.append(self._team(team) if isinstance(team, str) else -1)
+                key_label.append(self._label(label, kind))
+            self.team_stages.append({
+                'kind': kind,
+                'stage': self.stages.index(name) if kind == 'stage' else None,
+                'key_team': np.array(key_team, dtype=np.int64),
+                'key_label': np.array(key_label, dtype=np.int64),
+                'name_team': np.array([self._team(n) if isinstance(n, str) else -1 for n in team_stage['names']],
+                                      dtype=np.int64),
+                # float so the per scenario products go through BLAS, the counts stay exact
+                'teams': team_stage['teams'].T.astype(np.float32),
+                'team_names': team_stage['team_names'].T.astype(np.float32),
+                'ordered': team_stage['ordered'],
+                'qualified': team_stage['qualified'],
+                'ordering': team_stage['ordering'],
+            })
+
+    def _label(self, label, kind):
+        '''
+        -1 for plain team keys, otherwise an id comparable to the sampled
+        group position (group * 10 + position) or bonus question, -2 if unknown
+        '''
+        if label is None:
+            return -1
+        if kind == 'bonus':
+            return BONUS_QUESTIONS.index(label) if label in BONUS_QUESTIONS else -2
+        try:
+            return self.group_names.index(label[0]) * 10 + int(label[1:])
+        except (ValueError, TypeError, IndexError):
+            return -2
+
+    def sample(self, rng, n):
+        '''
+        total points of every participant in n sampled scenarios, n x participants
+        '''
+        F = len(self.played)
+        unplayed = ~self.played
+        home_goals = np.broadcast_to(self.home_goals, (n, F)).copy()
+        away_goals = np.broadcast_to(self.away_goals, (n, F)).copy()
+        home_goals[:, unplayed] = rng.poisson(self.goals, (n, unplayed.sum()))
+        away_goals[:, unplayed] = rng.poisson(self.goals, (n, unplayed.sum()))
+        outcome = np.broadcast_to(self.outcome, (n, F)).copy()
+        outcome[:, unplayed] = np.where(home_goals[:, unplayed] > away_goals[:, unplayed], 1,
+                                        np.where(home_goals[:, unplayed] < away_goals[:, unplayed], 2, 0))
+        knockout_draw = (self.fixture_stage > 0) & (outcome == 0)
+        outcome = np.where(knockout_draw, rng.integers(1, 3, (n, F)), outcome)
+
+        total = np.broadcast_to(self.fixed, (n, len(self.names))).astype(np.int64)
+        if len(self.slot_fixtures):
+            G = self.max_goals + 1
+            f = self.slot_fixtures
+            combo = (np.minimum(home_goals[:, f], self.max_goals) * G
+                     + np.minimum(away_goals[:, f], self.max_goals)) * 2 + np.maximum(outcome[:, f] - 1, 0)
+            points = self.tables[np.arange(len(f)), combo]
+            total = total + points.sum(axis=1, dtype=np.int64)
+
+        if self.team_stages:
+            members, labels, bonus = self._bracket(rng, home_goals, away_goals, outcome)
+            for team_stage in self.team_stages:
+                teams, names = self._memberships(team_stage, members, labels, bonus)
+                total = total + self._score_teams(team_stage, teams, names)
+        return total
+
+    def _group_tables(self, rng, home_goals, away_goals):
+        n = len(home_goals)
+        g = self.group_fixtures
+        hg, ag = home_goals[:, g], away_goals[:, g]
+        scored = hg @ self.home_incidence + ag @ self.away_incidence
+        conceded = ag @ self.home_incidence + hg @ self.away_incidence
+        points = ((3 * (hg > ag) + (hg == ag)) @ self.home_incidence
+                  + (3 * (ag > hg) + (hg == ag)) @ self.away_incidence)
+        # points, goal difference, goals scored, then a coin toss
+        key = points * 1e6 + (scored - conceded + 1000) * 1e3 + scored + rng.random((n, len(self.teams)))
+        position = np.zeros((n, len(self.teams)), dtype=np.int64)
+        for group in range(len(self.group_names)):
+            members = np.flatnonzero(self.team_group == group)
+            position[:, members] = np.argsort(np.argsort(-key[:, members], axis=1), axis=1) + 1
+        return scored, conceded, key, position
+
+    def _bracket(self, rng, home_goals, away_goals, outcome):
+        '''
+        per scenario: the team membership of every stage, the group position
+        labels and the bonus question answers
+        '''
+        n = len(home_goals)
+        T = len(self.teams)
+        scored, conceded, key, position = self._group_tables(rng, home_goals, away_goals)
+        labels = self.team_group * 10 + position
+        if self.group_complete and (self.config_labels >= 0).any():
+            labels = np.where(self.config_labels >= 0, self.config_labels, labels)
+        bonus = np.stack([scored == scored.max(axis=1, keepdims=True),
+                          scored == scored.min(axis=1, keepdims=True),
+                          conceded == conceded.max(axis=1, keepdims=True)], axis=1)
+
+        home = np.broadcast_to(self.fixture_home, (n, len(self.fixture_home))).copy()
+        away = np.broadcast_to(self.fixture_away, (n, len(self.fixture_away))).copy()
+        for k in range(1, len(self.stages)):
+            fixtures = np.flatnonzero(self.fixture_stage == k)
+            if ((home[:, fixtures] >= 0) & (away[:, fixtures] >= 0)).all():
+                continue
+            if k == 1:
+                pool = self._qualifiers(key, position)
+                half = pool.shape[1] // 2
+                home[:, fixtures] = pool[:, :half][:, :len(fixtures)]
+                away[:, fixtures] = pool[:, ::-1][:, :half][:, :len(fixtures)]
+            else:
+                previous = np.flatnonzero(self.fixture_stage == k - 1)
+                winners = np.where(outcome[:, previous] == 1, home[:, previous], away[:, previous])
+                for i, f in enumerate(fixtures):
+                    if 2 * i + 1 < winners.shape[1] and (self.fixture_home[f] < 0 or self.fixture_away[f] < 0):
+                        home[:, f] = winners[:, 2 * i]
+                        away[:, f] = winners[:, 2 * i + 1]
+
+        members = {}
+        rows = np.arange(n)[:, None]
+        for k in range(len(self.stages)):
+            fixtures = np.flatnonzero(self.fixture_stage == k)
+            member = np.zeros((n, T + 1), dtype=np.int64)
+            member[rows, np.where(home[:, fixtures] >= 0, home[:, fixtures], T)] = 1
+            member[rows, np.where(away[:, fixtures] >= 0, away[:, fixtures], T)] = 1
+            members[k] = member[:, :T]
+        if 'Final' in self.stages:
+            final = np.flatnonzero(self.fixture_stage == self.stages.index('Final'))[-1:]
+            champion = np.where(outcome[:, final] == 1, home[:, final], away[:, final])
+            member = np.zeros((n, T + 1), dtype=np.int64)
+            member[rows, np.where(champion >= 0, champion, T)] = 1
+            members['winner'] = member[:, :T]
+        return members, labels, bonus
+
+    def _qualifiers(self, key, position):
+        '''
+        group winners followed by the runners up and the best third placed
+        teams, as many as the Round of 16 needs
+        '''
+        fixtures = np.flatnonzero(self.fixture_stage == 1)
+        ranked = []
+        for place in (1, 2):
+            teams = np.argsort(np.where(position == place, -key, np.inf), axis=1)
+            ranked.append(teams[:, :len(self.group_names)])
+        thirds = np.argsort(np.where(position == 3, -key, np.inf), axis=1)
+        pool = np.concatenate(ranked + [thirds[:, :max(0, 2 * len(fixtures) - 2 * len(self.group_names))]], axis=1)
+        return pool
+
+    def _memberships(self, team_stage, members, labels, bonus):
+        n = len(labels)
+        key_team = team_stage['key_team']
+        known = key_team >= 0
+        safe = np.where(known, key_team, 0)
+        if team_stage['kind'] == 'bonus':
+            question = np.maximum(team_stage['key_label'], 0)
+            teams = bonus[:, question, safe] & known & (team_stage['key_label'] >= 0)
+            named = bonus.any(axis=1)
+        else:
+            member = members['winner'] if team_stage['kind'] == 'winner' else members[team_stage['stage']]
+            teams = member[:, safe].astype(bool) & known
+            labelled = team_stage['key_label'] != -1
+            teams &= ~labelled | (labels[:, safe] == team_stage['key_label'])
+            named = member.astype(bool)
+        name_team = team_stage['name_team']
+        names = named[:, np.where(name_team >= 0, name_team, 0)] & (name_team >= 0)
+        return teams.astype(np.float32).reshape(n, -1), names.astype(np.float32).reshape(n, -1)
+
+    @staticmethod
+    def _score_teams(team_stage, teams, names):
+        correct = np.rint(teams @ team_stage['teams']).astype(np.int64)
+        correct_names = np.rint(names @ team_stage['team_names']).astype(np.int64)
+        return np.where(team_stage['ordered'],
+                        team_stage['ordering'] * correct + team_stage['qualified'] * correct_names,
+                        team_stage['qualified'] * correct)
+
+    def tally(self, total):
+        '''
+        per participant counts of finishing 1st, 2nd and in the prizes, plus
+        the summed points and ranks of a batch of scenarios
+        '''
+        n, P = total.shape
+        # rank = 1 + number of participants with strictly more points, ties share the best rank
+        ascending = np.sort(total, axis=1)
+        span = int(total.max() - total.min()) + 1 if total.size else 1
+        offsets = np.arange(n, dtype=np.int64)[:, None] * span
+        above = np.searchsorted((ascending + offsets).ravel(), (total + offsets).ravel(), side='right')
+        rank = P - (above.reshape(n, P) - offsets // span * P) + 1
+        return {
+            'first': (rank == 1).sum(axis=0),
+            'second': (rank == 2).sum(axis=0),
+            'prize': (rank <= self.prizes).sum(axis=0),
+            'points': total.sum(axis=0),
+            'rank': rank.sum(axis=0),
+        }
+
+    def chunk_size(self):
+        cells = max(1, len(self.slot_fixtures) * len(self.names))
+        return int(min(20000, max(100, CHUNK_CELLS // cells)))
+
+    def run(self, scenarios=100000, workers=None, seed=None):
+        '''
+        probabilities of finishing 1st, 2nd and in the prize positions over
+        scenarios simulated tournaments, spread over workers processes
+        '''
+        started = time.time()
+        chunk = self.chunk_size()
+        sizes = [chunk] * (scenarios // chunk) + ([scenarios % chunk] if scenarios % chunk else [])
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(sizes) == 1:
+            results = [_run_chunk(self, s, size) for s, size in zip(seeds, sizes)]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,)) as executor:
+                results = list(executor.map(_run_worker_chunk, seeds, sizes))
+
+        counts = {k: sum(r[k] for r in results) for k in results[0]}
+        res = pd.DataFrame({
+            'Win': counts['first'] / scenarios,
+            'Runner Up': counts['second'] / scenarios,
+            'Prize': counts['prize'] / scenarios,
+            'Expected Points': counts['points'] / scenarios,
+            'Expected Rank': counts['rank'] / scenarios,
+        }, index=self.names)
+        res.index.name = 'Name'
+        print(f'simulated {scenarios} scenarios in {time.time() - started:.1f}s on {workers} workers')
+        return res.sort_values(['Win', 'Prize', 'Expected Points'], ascending=False)
+
+
+def _run_chunk(simulator, seed, size):
+    rng = np.random.default_rng(seed)
+    return simulator.tally(simulator.sample(rng, size))
+
+_worker_simulator = None
+
+def _init_worker(simulator):
+    global _worker_simulator
+    _worker_simulator = simulator
+
+def _run_worker_chunk(seed, size):
+    return _run_chunk(_worker_simulator, seed, size)
+
+
+if __name__ == '__main__':
+    from util import DB, config
+    from predictor import Tournament
+    scenarios = int(sys.argv[1]) if len(sys.argv) > 1 else config.get('simulation', {}).get('scenarios', 100000)
+    db = DB(config['sql'])
+    tournament = Tournament(config['tournament'], db, config)
+    for cid, comp in tournament.competitions.items():
+        print(comp)
+        print(Simulator.from_tournament(tournament, cid).run(scenarios).to_string())
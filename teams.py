@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import yaml
+
+codes_path = os.environ.get("TEAMS_YML", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'teams.yml'))
+code_url = 'http://www.rsssf.com/miscellaneous/fifa-codes.html'
+
+# rsssf spellings which differ from the names used in the fixtures
+renames = {
+    'Macedonia FYR': 'North Macedonia',
+    'Holland': 'Netherlands',
+    'United States of America': 'Usa',
+    'Korea Republic': 'South Korea',
+}
+
+
+def load_fifa_codes(path=codes_path):
+    '''
+    two way mapping of team name <-> FIFA code from the bundled registry
+
+    aliases and title cased names (as looked up through team.title()) map
+    to a code but codes always map back to the registry name
+    '''
+    with open(path, 'r') as f:
+        registry = yaml.safe_load(f)
+    codes = dict(registry['codes'])
+    fifa_codes = dict(codes)
+    fifa_codes.update({v:k for k,v in codes.items()})
+    for name, code in list(codes.items()) + list(registry.get('aliases', {}).items()):
+        fifa_codes.setdefault(name, code)
+        fifa_codes.setdefault(name.title(), code)
+    return fifa_codes
+
+def scrape_fifa_codes(url=code_url):
+    import requests
+    from bs4 import BeautifulSoup
+
+    print('fetching markup from ' + url)
+    codes = BeautifulSoup(requests.get(url).text, 'html.parser')
+    codes = codes.pre.get_text().splitlines()
+    codes = [l.replace('\t', '').replace('-----','---') for l in codes if '\t' in l]
+    codes = {l[:-6]:l[-6:-3] for l in codes}
+    for old, new in renames.items():
+        if old in codes:
+            codes[new] = codes.pop(old)
+    codes['Australia'] = 'AUS'
+    return {k:v for k,v in codes.items() if v.isalpha()}
+
+def refresh_fifa_codes(path=codes_path):
+    '''
+    re-scrape the codes and rewrite the registry, bumping its version
+
+    existing entries are kept so hand edits survive a refresh
+    '''
+    with open(path, 'r') as f:
+        text = f.read()
+    registry = yaml.safe_load(text)
+    header = [l for l in text.splitlines() if l.startswith('#')][:3]
+    codes = scrape_fifa_codes(registry.get('source', code_url))
+    codes.update(registry['codes'])
+    registry['version'] += 1
+    registry['codes'] = dict(sorted(codes.items()))
+    with open(path, 'w') as f:
+        f.write('\n'.join(header) + '\n')
+        yaml.safe_dump(registry, f, allow_unicode=True, sort_keys=False)
+    print(f"wrote {len(codes)} codes to {path} (version {registry['version']})")
+
+fifa_codes = load_fifa_codes()
+
+if __name__ == '__main__':
+    if '--refresh' in sys.argv:
+        refresh_fifa_codes()
+    else:
+        print(f'{len(fifa_codes)} entries loaded from {codes_path}')
@@ -1,9 +1,16 @@
 import os.path
 import base64
+import random
+import threading
 import MySQLdb
 import yaml
 
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
+from time import sleep, time, monotonic, perf_counter
+
+from metrics import metrics
 
 USE_GOOGLE = int(os.environ.get("USE_GOOGLE", 1))
 
@@ -277,6 +284,104 @@ def get_sheet_data(service, sheet_id, ranges, value_render_option='FORMATTED_VAL
         res[k] = v['values']
     return res
 
+def sheets_factory(creds):
+    '''
+    googleapiclient services are not thread safe, this builds one per fetcher thread
+    '''
+    return lambda: build('sheets', 'v4', credentials=creds)
+
+class TokenBucket():
+    '''
+    allows rate requests per second on average with bursts of up to capacity requests
+    '''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+class SheetFetcher():
+    '''
+    reads the same ranges from many sheets concurrently while staying within
+    the Sheets API read quota, requests rejected with a 429 (or a transient
+    5xx) are retried with exponential backoff
+
+    service - a sheets service, or a callable building one, in which case every
+              worker thread gets its own service and requests run in parallel
+    quota - read requests per minute
+    '''
+
+    retry_status = (429, 500, 502, 503)
+
+    def __init__(self, service, quota=60, burst=5, workers=8, retries=5, backoff=2):
+        self.service = service
+        self.bucket = TokenBucket(quota / 60, burst)
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.shared = not (callable(service) and not hasattr(service, 'spreadsheets'))
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _get(self, sheet_id, ranges, value_render_option):
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                if self.shared:
+                    with self.lock:
+                        return get_sheet_data(self.service, sheet_id, ranges, value_render_option)
+                if not hasattr(self.local, 'service'):
+                    self.local.service = self.service()
+                return get_sheet_data(self.local.service, sheet_id, ranges, value_render_option)
+            except Exception as e:
+                status = getattr(getattr(e, 'resp', None), 'status', None)
+                if status not in self.retry_status or attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt + random.uniform(0, 1)
+                print(f'sheet {sheet_id} returned {status}, retrying in {delay:.1f}s')
+                sleep(delay)
+
+    def fetch(self, sheet_ids, ranges, value_render_option='FORMATTED_VALUE'):
+        '''
+        sheet_ids - dict of key -> sheet id
+        returns a dict of key -> get_sheet_data result, sheets which could not be read are left out
+        '''
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = {key: pool.submit(self._get, sheet_id, ranges, value_render_option)
+                       for key, sheet_id in sheet_ids.items()}
+        res = {}
+        for key, future in futures.items():
+            try:
+                res[key] = future.result()
+            except Exception as e:
+                print(f'unable to fetch sheet for {key}: {e}')
+        return res
+
+def get_fetcher(sheets):
+    if isinstance(sheets, SheetFetcher):
+        return sheets
+    return SheetFetcher(sheets, quota=config['google_api'].get('read_quota', 60))
+
+def sheet_fetcher(creds):
+    '''
+    a SheetFetcher reading in parallel, with a service per worker thread
+    '''
+    return SheetFetcher(sheets_factory(creds), quota=config['google_api'].get('read_quota', 60))
+
 def lock_sheet_phase_1(service, sheet_id):
     body = {
         "requests": [
@@ -309,6 +414,18 @@ def lock_sheet_phase_1(service, sheet_id):
 # ----------------------------- SQL FUNCTIONS ---------------------------------- #
 
 class DB:
+    '''
+    thread safe pool of MySQL connections
+
+    connections run in autocommit mode so neither reads nor single writes
+    need an extra commit round-trip, and are pinged before reuse only once
+    they have been idle for longer than health_check_interval seconds, or
+    always before a transaction. When the server drops a connection the idle
+    ones are pinged too, so a restart costs one failed query rather than one
+    per pooled connection
+    '''
+
+    readonly_statements = ('SELECT', 'SHOW', 'CHECKSUM')
     
     def __init__(self, config):
         host = config['host']
@@ -319,30 +436,206 @@ class DB:
         self.user = os.environ.get(user, user)
         self.passwd = os.environ.get(passwd, passwd)
         self.db = os.environ.get(db, db)
-        self.conn = None
+        self.pool_size = int(os.environ.get("DB_POOL_SIZE", config.get('pool_size', 4)))
+        self.pool_timeout = config.get('pool_timeout', 30)
+        self.health_check_interval = config.get('health_check_interval', 30)
+        self.pool = LifoQueue()
+        self.lock = threading.Lock()
+        self.stats = {'open': 0, 'in_use': 0, 'queries': 0, 'waits': 0, 'health_checks': 0, 'reconnects': 0}
 
-    def _reconnect(func):
-        def wrapper(self, *args, **kwargs):
-            try:
-                self.conn.commit()
-            except (AttributeError, MySQLdb.OperationalError):
-                self.connect()
-            res = func(self, *args, **kwargs)
-            self.conn.commit()
-            return res
-        return wrapper
-            
     def connect(self):
-        self.conn = MySQLdb.connect(host=self.host, passwd=self.passwd, user=self.user, db=self.db)
+        return MySQLdb.connect(host=self.host, passwd=self.passwd, user=self.user, db=self.db, autocommit=True)
+
+    def acquire(self, check=False):
+        '''
+        check - ping the connection even if it was used recently
+        '''
+        conn = None
+        with self.lock:
+            try:
+                conn, last_used = self.pool.get_nowait()
+            except Empty:
+                create = self.stats['open'] < self.pool_size
+                if create:
+                    self.stats['open'] += 1
+                else:
+                    self.stats['waits'] += 1
+
+        if conn is None and create:
+            try:
+                conn = self.connect()
+            except Exception:
+                with self.lock:
+                    self.stats['open'] -= 1
+                raise
+            last_used = None
+        elif conn is None:
+            try:
+                conn, last_used = self.pool.get(timeout=self.pool_timeout)
+            except Empty:
+                raise MySQLdb.OperationalError(f'no connection available after {self.pool_timeout}s')
+
+        checked = last_used is not None and (check or time() - last_used > self.health_check_interval)
+        reconnected = False
+        if checked:
+            try:
+                conn.ping()
+            except (MySQLdb.OperationalError, MySQLdb.InterfaceError):
+                try:
+                    conn.close()
+                except MySQLdb.Error:
+                    pass
+                try:
+                    conn = self.connect()
+                except Exception:
+                    # give the slot back or the pool shrinks for good
+                    with self.lock:
+                        self.stats['open'] -= 1
+                    raise
+                reconnected = True
+
+        with self.lock:
+            self.stats['in_use'] += 1
+            self.stats['health_checks'] += checked
+            self.stats['reconnects'] += reconnected
+        return conn
+
+    def release(self, conn, broken=False):
+        with self.lock:
+            self.stats['in_use'] -= 1
+            if broken:
+                self.stats['open'] -= 1
+        if broken:
+            try:
+                conn.close()
+            except MySQLdb.Error:
+                pass
+        else:
+            self.pool.put((conn, time()))
+
+    def prune(self):
+        '''
+        ping the idle connections, closing those the server dropped
+        '''
+        idle = []
+        while True:
+            try:
+                idle.append(self.pool.get_nowait())
+            except Empty:
+                break
+        dropped = 0
+        for conn, last_used in idle:
+            try:
+                conn.ping()
+            except (MySQLdb.OperationalError, MySQLdb.InterfaceError):
+                dropped += 1
+                try:
+                    conn.close()
+                except MySQLdb.Error:
+                    pass
+            else:
+                self.pool.put((conn, time()))
+        with self.lock:
+            self.stats['open'] -= dropped
+            self.stats['health_checks'] += len(idle)
+        if dropped:
+            print(f'closed {dropped} dropped connections')
+
+    @contextmanager
+    def connection(self, check=False):
+        '''
+        borrow a connection from the pool, it is discarded if the server drops
+        it, along with the idle connections the server dropped as well
+        '''
+        conn = self.acquire(check)
+        broken = False
+        try:
+            yield conn
+        except (MySQLdb.OperationalError, MySQLdb.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.release(conn, broken)
+            if broken:
+                self.prune()
+
+    @contextmanager
+    def transaction(self):
+        '''
+        cursor whose statements are committed together, or rolled back if any of them fails
+
+        the connection is pinged first, and replaced if the server dropped it
+        '''
+        with self.connection(check=True) as conn:
+            c = conn.cursor()
+            c.execute('START TRANSACTION')
+            try:
+                yield c
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+            finally:
+                c.close()
+
+    def execute_many(self, *statements):
+        '''
+        statements - (query, rows) pairs, each query is run for every one of
+        its rows and all of them in a single transaction. MySQLdb sends
+        INSERT and REPLACE statements as one multi-row VALUES statement
+        returns the number of rows affected
+        '''
+        statements = [(query, list(rows)) for query, rows in statements]
+        statements = [(query, rows) for query, rows in statements if rows]
+        if not statements:
+            return 0
+        count = 0
+        with self.transaction() as c:
+            for query, rows in statements:
+                started = perf_counter()
+                c.executemany(query, rows)
+                count += c.rowcount
+                metrics.query(self.statement(query), perf_counter() - started)
+        with self.lock:
+            self.stats['queries'] += len(statements)
+        return count
+
+    def pool_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats['size'] = self.pool_size
+        stats['idle'] = self.pool.qsize()
+        return stats
+
+    @staticmethod
+    def statement(query):
+        return query.lstrip().split(None, 1)[0].upper()
+
+    def is_readonly(self, query):
+        return self.statement(query) in self.readonly_statements
     
-    @_reconnect
     def query(self, query, args=None):
-        res = None
-        c = self.conn.cursor()
-        exists = c.execute(query, args)
-        if exists:
-            res = c.fetchall()
-        c.close()
+        started = perf_counter()
+        # a read is safe to retry if the server went away, the connection it
+        # gets next has been pinged or is new
+        attempts = 2 if self.is_readonly(query) else 1
+        for attempt in range(attempts):
+            try:
+                with self.connection() as conn:
+                    res = None
+                    c = conn.cursor()
+                    exists = c.execute(query, args)
+                    if exists:
+                        res = c.fetchall()
+                    c.close()
+                break
+            except MySQLdb.OperationalError:
+                if attempt + 1 == attempts:
+                    raise
+        with self.lock:
+            self.stats['queries'] += 1
+        metrics.query(self.statement(query), perf_counter() - started)
         while isinstance(res, tuple) and len(res)==1:
             res = res[0]
         return res
@@ -365,7 +658,13 @@ class DB:
     
 # ------------------------ GET SHEET DATA --------------------------------------
 
-def update_predictions_db(sheets, db, phase):
+def update_predictions_db(sheets, db, phase, fetcher=None):
+    '''
+    fetcher - SheetFetcher used to read the participant sheets, one sharing sheets is used if not given
+
+    the participants whose sheet could not be read are not updated, a
+    RuntimeError naming them is raised once the others are
+    '''
 
     match_query = """REPLACE INTO match_prediction (home_score , away_score , match_id , match_result , phase, participant_id ) 
             VALUES (%s,%s,%s,%s,%s,%s)"""
@@ -376,14 +675,18 @@ def update_predictions_db(sheets, db, phase):
     participant_sheets = db.get('participant', 'id, sheet_id')
     if not isinstance(participant_sheets[0], tuple):
         participant_sheets = [participant_sheets]
+    missing = []
     
     if phase == 1:
         template_id = config['google_api']['template_id']
         gs_row_map = group_stage_row_map(sheets, template_id, db)
         sheet_ranges = config['sheet_ranges']['Phase 1'] 
+        sheet_data = get_fetcher(fetcher or sheets).fetch(dict(participant_sheets), sheet_ranges)
+        missing = [pid for pid, _ in participant_sheets if pid not in sheet_data]
 
-        for pid, sheet_id in participant_sheets:
-            data = get_sheet_data(sheets, sheet_id, sheet_ranges)
+        for pid, data in sheet_data.items():
+            match_entries = []
+            team_entries = []
             gs = data.pop('Group Stage')
             for i, score in enumerate(gs):
                 if isinstance(score, list): score = score[0]
@@ -392,41 +695,46 @@ def update_predictions_db(sheets, db, phase):
                 if is_reversed:
                     home_score, away_score = away_score, home_score
                 match_result = None
-                entry = (home_score, away_score, match_id, match_result, phase, pid)
-                db.query(match_query, entry)
+                match_entries.append((home_score, away_score, match_id, match_result, phase, pid))
             
             ro16 = data.pop('Round of 16')
-            db.query(delete_team_query, ('Round of 16', phase, pid))
             for row in ro16:
                 team_a_order = int(row[0][0])
                 team_a = row[1]
-                entry = (team_a, 'Round of 16', team_a_order, phase, pid)
-                db.query(insert_team_query, entry)
+                team_entries.append((team_a, 'Round of 16', team_a_order, phase, pid))
                 team_b_order = int(row[2][0])
                 team_b = row[3]
-                entry = (team_b, 'Round of 16', team_b_order, phase, pid)
-                db.query(insert_team_query, entry)
+                team_entries.append((team_b, 'Round of 16', team_b_order, phase, pid))
             
-                
             for stage, dat in data.items():
-                db.query(delete_team_query, (stage, phase, pid))
                 for team in dat:
                     if isinstance(team, list): team = team[0]
-                    entry = (team, stage, None, phase, pid)
-                    db.query(insert_team_query, entry)
+                    team_entries.append((team, stage, None, phase, pid))
+
+            # all of a participant's predictions are replaced atomically
+            stages = ['Round of 16'] + list(data.keys())
+            db.execute_many((delete_team_query, [(stage, phase, pid) for stage in stages]),
+                            (match_query, match_entries),
+                            (insert_team_query, team_entries))
     
     if phase == 2:
 
         # TODO Test this before actually using it 
         sheet_ranges = config['sheet_ranges']['Phase 2'] 
-        for pid, sheet_id in participant_sheets:
-            data = get_sheet_data(sheets, sheet_id, sheet_ranges)
+        stage_match_ids = {}
+        for stage in sheet_ranges:
+            match_ids = db.get("fixtures", "id", order_by="kickoff", stage=stage)
+            if not isinstance(match_ids, (list, tuple)):
+                match_ids = [match_ids]
+            stage_match_ids[stage] = match_ids
+
+        sheet_data = get_fetcher(fetcher or sheets).fetch(dict(participant_sheets), sheet_ranges)
+        missing = [pid for pid, _ in participant_sheets if pid not in sheet_data]
+        for pid, data in sheet_data.items():
+            match_entries = []
+            team_entries = []
             for stage, dat in data.items():
-                db.query(delete_team_query, (stage, phase, pid))
-                match_ids = db.get("fixtures", "id", order_by="kickoff", stage=stage)
-                if not isinstance(match_ids, (list, tuple)):
-                    match_ids = [match_ids]
-                for match_id, (home_team, home_score, away_team, away_score) in zip(match_ids, dat):
+                for match_id, (home_team, home_score, away_team, away_score) in zip(stage_match_ids[stage], dat):
                     score = f'{home_score}-{away_score}'
                     if '*' in score:
                         o = score.find('*') - score.find('-')
@@ -438,16 +746,25 @@ def update_predictions_db(sheets, db, phase):
                         away_score = away_score.replace('*', '')
                     else:
                         match_result = None
-                    match_entry = (home_score, away_score, match_id, match_result, phase, pid)
-                    db.query(match_query, match_entry)
-                    home_team_entry = (home_team, stage, None, phase, pid)
-                    away_team_entry = (away_team, stage, None, phase, pid)
-                    db.query(insert_team_query, home_team_entry)
-                    db.query(insert_team_query, away_team_entry)
+                    match_entries.append((home_score, away_score, match_id, match_result, phase, pid))
+                    team_entries.append((home_team, stage, None, phase, pid))
+                    team_entries.append((away_team, stage, None, phase, pid))
+
+            db.execute_many((delete_team_query, [(stage, phase, pid) for stage in data]),
+                            (match_query, match_entries),
+                            (insert_team_query, team_entries))
             print(f'{pid} done!')
 
+    if missing:
+        raise RuntimeError(f'unable to read the sheets of participants {missing}, their predictions were not updated')
 
-def check_status_sheet(sheets, db, phase):
+
+def check_status_sheet(sheets, db, phase, fetcher=None):
+    '''
+    fetcher - SheetFetcher used to read the participant sheets, one sharing sheets is used if not given
+
+    participants whose sheet could not be read are listed as Unreadable Sheet
+    '''
     participant_sheets = db.get('participant', 'name, paid, competition_id, sheet_id')
 
     ranges = {
@@ -457,10 +774,19 @@ def check_status_sheet(sheets, db, phase):
 
     res = {}
 
+    sheet_ids = {sheet_id: sheet_id for name, paid, cid, sheet_id in participant_sheets}
+    sheet_checks = get_fetcher(fetcher or sheets).fetch(sheet_ids, ranges)
+
     for name, paid, cid, sheet_id in participant_sheets:
         if not cid in res:
-            res[cid] = {'Complete':[], 'Missing Predictions':[], 'Pending Payment':[]}
-        checks = get_sheet_data(sheets, sheet_id, ranges)
+            res[cid] = {'Complete':[], 'Missing Predictions':[], 'Pending Payment':[], 'Unreadable Sheet':[]}
+        checks = sheet_checks.get(sheet_id)
+        if checks is None:
+            print(f'unable to check the sheet of {name}')
+            res[cid]['Unreadable Sheet'].append(name)
+            if not paid:
+                res[cid]['Pending Payment'].append(name)
+            continue
         if phase == 1:
             check = checks['phase I'][0][0]
         elif phase == 2:
@@ -473,8 +799,6 @@ def check_status_sheet(sheets, db, phase):
             res[cid]['Missing Predictions'].append(name)
         if paid and complete:
             res[cid]['Complete'].append(name)
-        
-        sleep(3)
 
     return res
 
@@ -614,8 +938,9 @@ if 1 and __name__ == '__main__':
     tid = '192NYpfnQj6e8zhwN_a21Mi_uYfj8epel_X5x4oBd_rA'
     sheet_id = '1fYceYMnyjwWbUN8UhiJ-_MDSKQJ_KL4rmWWKKsQUvvI'
     db = DB(config['sql'])
-    # res = check_status_sheet(services['sheets'], db, phase=2)
+    fetcher = sheet_fetcher(creds)
+    # res = check_status_sheet(services['sheets'], db, phase=2, fetcher=fetcher)
     # lock_prediction_sheet(services['sheets'],db,2)
-    update_predictions_db(services['sheets'],db,2)
+    update_predictions_db(services['sheets'],db,2, fetcher=fetcher)
 
 